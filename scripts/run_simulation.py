@@ -8,6 +8,9 @@ from tqdm import tqdm
 from scripts.parse_enron import Message
 from simulations import agent
 from simulations.scenarios import do_simulation_step, init_simulations
+from simulations.scenarios import record_agent_memory_sizes
+from simulations.scenarios import validate_fast_backend, warm_up
+from simulations.snapshot import load_snapshot, save_snapshot
 from simulations.utils import Context
 from simulations.agent import AgentSettings
 
@@ -25,6 +28,68 @@ flags.DEFINE_integer('key_update_every_nb_days', 90,
 flags.DEFINE_enum('introduction_policy', 'public_contacts',
                   ['implicit_cc', 'public_contacts'],
                   'Introduction policy.')
+flags.DEFINE_enum('conflict_resolution_policy', 'latest_timestamp',
+                  ['latest_timestamp', 'fork_detecting'],
+                  'Conflict resolution policy.')
+flags.DEFINE_enum('chain_update_policy', 'immediate',
+                  ['immediate', 'buffered', 'windowed', 'staleness_bound'],
+                  'Chain update policy.')
+flags.DEFINE_integer('chain_update_buffer_size', 5,
+                     'Number of queued updates that the buffered policy '
+                     'commits at once.')
+flags.DEFINE_integer('chain_update_window', 24 * 60 * 60,
+                     'Min time between commits of the windowed policy, '
+                     'in seconds.')
+flags.DEFINE_integer('chain_update_max_staleness', 24 * 60 * 60,
+                     'Max time that the staleness-bound policy holds back '
+                     'an update, in seconds.')
+flags.DEFINE_integer('group_capability_min_size', None,
+                     ('Grant capabilities to a shared group key when the '
+                      'implicit CC policy introduces at least this many '
+                      'recipients to each other.'))
+flags.DEFINE_integer('gossip_store_gc_threshold', None,
+                     ('Evict superseded objects from the gossip store of an '
+                      'agent once it holds this many objects.'))
+flags.DEFINE_bool('reuse_encodings', False,
+                  ('Reuse encoded claims and capabilities across commits. '
+                   'This is a protocol deviation: the block nonce is reused '
+                   'until the next key update, so observers can link '
+                   'unchanged entries across blocks.'))
+flags.DEFINE_integer('max_resident_agents', None,
+                     ('Max number of agents to keep in memory. The rest '
+                      'are spilled to disk.'))
+flags.DEFINE_string('spill_path', None,
+                    'Path to the database of spilled agents.')
+flags.DEFINE_bool('stub_outside_userset', False,
+                  ('Simulate users outside of the userset with stub agents '
+                   'that only relay the heads they receive, without claim '
+                   'maps.'))
+flags.DEFINE_enum('payload_compression', None, ['auto', 'zlib', 'zstd'],
+                  ('Compress message payloads, and report the compressed '
+                   'sizes.'))
+flags.DEFINE_bool('shared_dictionaries', False,
+                  ('Compress payloads against the recent payloads between '
+                   'the same sender and recipient.'))
+flags.DEFINE_bool('wire_messages', False,
+                  ('Encode messages into buffers, decode them on the '
+                   'recipients\' side, and report the encoding and decoding '
+                   'times.'))
+flags.DEFINE_bool('record_memory_sizes', False,
+                  ('Record the memory taken by each agent in memory at the '
+                   'end. Spilled agents are skipped.'))
+flags.DEFINE_string('load_snapshot', None,
+                    'Start from a snapshot of the state after earlier entries.')
+flags.DEFINE_string('save_snapshot', None,
+                    'Save a snapshot of the state at the end to this path.')
+flags.DEFINE_integer('warm_up_entries', 0,
+                     ('Approximate the state after this many entries before '
+                      'the starting entry, instead of starting cold.'))
+flags.DEFINE_bool('fast_backend', False,
+                  'Use crypto-free stand-ins instead of real ClaimChain.')
+flags.DEFINE_integer('validate_fast_backend', 0,
+                     ('Compare the fast backend with real ClaimChain on '
+                      'this many log entries before the simulations, and '
+                      'fail if they do not match.'))
 flags.DEFINE_string('parsed_enron_path', 'data/enron/parsed',
                     'Path to directory with parsed Enron pickles.')
 flags.DEFINE_string('output',
@@ -32,13 +97,37 @@ flags.DEFINE_string('output',
                     'Path and name of the output pickle.')
 
 
-def make_agent_settings(key_update_every_nb_days, introduction_policy):
+CONFLICT_RESOLUTION_POLICIES = {
+    'latest_timestamp': agent.latest_timestamp_resolution_policy,
+    'fork_detecting': agent.fork_detecting_resolution_policy,
+}
+
+
+CHAIN_UPDATE_POLICIES = {
+    'immediate': agent.immediate_chain_update_policy,
+    'buffered': agent.buffered_chain_update_policy,
+    'windowed': agent.windowed_chain_update_policy,
+    'staleness_bound': agent.staleness_bound_chain_update_policy,
+}
+
+
+def make_agent_settings(key_update_every_nb_days, introduction_policy,
+                        fast_backend=False, chain_update_policy='immediate',
+                        conflict_resolution_policy='latest_timestamp',
+                        **extra_settings):
     if introduction_policy == 'implicit_cc':
         policy_fn = agent.implicit_cc_introduction_policy
     elif introduction_policy == 'public_contacts':
         policy_fn = agent.public_contacts_policy
     return AgentSettings(key_update_every_nb_days=key_update_every_nb_days,
-                         introduction_policy=policy_fn)
+                         introduction_policy=policy_fn,
+                         fast_backend=fast_backend,
+                         chain_update_policy=CHAIN_UPDATE_POLICIES[
+                                 chain_update_policy],
+                         conflict_resolution_policy=(
+                                 CONFLICT_RESOLUTION_POLICIES[
+                                         conflict_resolution_policy]),
+                         **extra_settings)
 
 
 def get_parsed_data(parsed_enron_path):
@@ -50,28 +139,85 @@ def get_parsed_data(parsed_enron_path):
 
 
 def run_simulations(settings, enron_log, social_graph, max_entries, log_offset,
-                    save_every_num, output, pbar=tqdm):
+                    save_every_num, output, pbar=tqdm,
+                    max_resident_agents=None, spill_path=None,
+                    stub_outside_userset=False, payload_compression=None,
+                    shared_dictionaries=False, snapshot_input=None,
+                    snapshot_output=None, warm_up_entries=0,
+                    wire_messages=False, record_memory_sizes=False):
     context = Context(enron_log[log_offset:log_offset+max_entries],
                       social_graph=social_graph)
-    state, reports = init_simulations(context)
+    snapshot = None
+    if snapshot_input is not None:
+        snapshot = load_snapshot(snapshot_input)
     with settings.as_default():
-        for index, email in pbar(list(enumerate(context.log))):
-            state, reports = do_simulation_step(index, email, state, reports)
-            if index % save_every_num == 0:
-                with open(output, 'wb') as h:
-                   pickle.dump(reports, h)
+        state, reports = init_simulations(context, max_resident_agents,
+                                          spill_path, stub_outside_userset,
+                                          payload_compression,
+                                          shared_dictionaries, snapshot,
+                                          wire_messages, record_memory_sizes)
+    # The agents of the snapshot are in the state now.
+    del snapshot
+    try:
+        with settings.as_default():
+            if warm_up_entries:
+                warm_up_start = max(0, log_offset - warm_up_entries)
+                warm_up(state, enron_log[warm_up_start:log_offset], pbar=pbar)
+            for index, email in pbar(list(enumerate(context.log))):
+                state, reports = do_simulation_step(index, email, state,
+                                                    reports)
+                if index % save_every_num == 0:
+                    with open(output, 'wb') as h:
+                       pickle.dump(reports, h)
 
-    with open(output, 'wb') as h:
-       pickle.dump(reports, h)
+        if record_memory_sizes:
+            record_agent_memory_sizes(state, reports)
+        with open(output, 'wb') as h:
+           pickle.dump(reports, h)
+        if snapshot_output is not None:
+            save_snapshot(state, snapshot_output)
+    finally:
+        state.close()
 
 
 def main(argv):
     enron_log, social_graph = get_parsed_data(FLAGS.parsed_enron_path)
     settings = make_agent_settings(FLAGS.key_update_every_nb_days,
-                                   FLAGS.introduction_policy)
+                                   FLAGS.introduction_policy,
+                                   FLAGS.fast_backend,
+                                   FLAGS.chain_update_policy,
+                                   FLAGS.conflict_resolution_policy,
+                                   chain_update_buffer_size=(
+                                       FLAGS.chain_update_buffer_size),
+                                   chain_update_window=(
+                                       FLAGS.chain_update_window),
+                                   chain_update_max_staleness=(
+                                       FLAGS.chain_update_max_staleness),
+                                   group_capability_min_size=(
+                                       FLAGS.group_capability_min_size),
+                                   gossip_store_gc_threshold=(
+                                       FLAGS.gossip_store_gc_threshold),
+                                   reuse_encodings=FLAGS.reuse_encodings)
+    if FLAGS.validate_fast_backend:
+        sample_end = FLAGS.log_offset + FLAGS.validate_fast_backend
+        context = Context(enron_log[FLAGS.log_offset:sample_end],
+                          social_graph)
+        with settings.as_default():
+            validate_fast_backend(context, FLAGS.validate_fast_backend)
+
     report = run_simulations(settings, enron_log, social_graph,
                              FLAGS.max_entries, FLAGS.log_offset,
-                             FLAGS.save_every_num, FLAGS.output)
+                             FLAGS.save_every_num, FLAGS.output,
+                             max_resident_agents=FLAGS.max_resident_agents,
+                             spill_path=FLAGS.spill_path,
+                             stub_outside_userset=FLAGS.stub_outside_userset,
+                             payload_compression=FLAGS.payload_compression,
+                             shared_dictionaries=FLAGS.shared_dictionaries,
+                             snapshot_input=FLAGS.load_snapshot,
+                             snapshot_output=FLAGS.save_snapshot,
+                             warm_up_entries=FLAGS.warm_up_entries,
+                             wire_messages=FLAGS.wire_messages,
+                             record_memory_sizes=FLAGS.record_memory_sizes)
 
 
 if __name__ == '__main__':
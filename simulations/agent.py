@@ -4,6 +4,7 @@ Simulated MUA that uses ClaimChain.
 
 import os
 import six
+import struct
 import base64
 import msgpack
 import warnings
@@ -12,13 +13,25 @@ import logging
 
 from collections import defaultdict
 from datetime import datetime
+from hashlib import sha256
 
 from attr import attrs, attrib
 from hippiehug import Chain, Block
-from claimchain import State, View, LocalParams
-from claimchain.utils import ObjectStore, serialize_object
+from hippiehug.Nodes import Branch, Leaf
+from hippiehug.Utils import binary_hash
+from claimchain import View, LocalParams
+from claimchain.utils import ObjectStore, ascii2bytes, serialize_object
+from claimchain.utils.wrappers import Blob, Tree
 from defaultcontext import with_default_context
 
+from .ancestry import AncestryIndex
+from .fast import FastParams, FastState, FastView, SIGNATURE_STAND_IN
+from .state import BatchState, CachingState
+from .utils import EMPTY_DICT, EMPTY_SET
+from .utils import EvictableObjectStore, LRUCache, OverlayStore
+from .utils import PooledObjectStore
+from .utils import VerifiedObjectStore
+
 
 logger = logging.getLogger(__name__)
 
@@ -29,19 +42,72 @@ PUBLIC_READER_PARAMS = LocalParams.generate()
 
 PUBLIC_READER_LABEL = 'public'
 
+GROUP_LABEL_PREFIX = 'group:'
+
+# Encoding a claim takes about as much CPU time as encoding this many
+# capabilities, mostly for its VRF.
+GROUP_KEY_CLAIM_COST = 32
+
+
+BLOCK_CACHE_SIZE = 2 ** 16
+
+# Blocks are fully determined by their hashes, so the encoded and decoded
+# blocks are shared by all agents.
+encoded_block_cache = LRUCache(BLOCK_CACHE_SIZE)
+decoded_block_cache = LRUCache(BLOCK_CACHE_SIZE)
+# Decoded head blocks, payloads, and owners' params of views, by heads.
+decoded_view_cache = LRUCache(BLOCK_CACHE_SIZE)
+
+
+def serialize_block(block, block_hash=None):
+    """Encode a block into bytes using msgpack.
+
+    :param block: Block to encode
+    :param block_hash: Hash of the block, if known. Enables caching.
+    """
+    if block_hash is not None:
+        serialized_block = encoded_block_cache.get(block_hash)
+        if serialized_block is not None:
+            return serialized_block
 
-def serialize_block(block):
-    """Encode a block into bytes using msgpack."""
     as_tuple = block.index, block.fingers, block.items, block.aux
-    return msgpack.packb(as_tuple,
+    serialized_block = msgpack.packb(as_tuple,
             use_bin_type=True, encoding="utf-8")
+    if block_hash is not None:
+        encoded_block_cache[block_hash] = serialized_block
+    return serialized_block
+
+
+class DecodedBlock(Block):
+    """Block decoded from bytes.
+
+    Decoded blocks are shared and never modified, so their hashes are
+    only computed once.
+    """
+    @property
+    def hid(self):
+        try:
+            return self._hid
+        except AttributeError:
+            self._hid = self.hash()
+            return self._hid
 
 
 def deserialize_block(serialized_block):
-    """Decode a block from msgpack-serialized bytes."""
+    """Decode a block from msgpack-serialized bytes.
+
+    Decoded blocks are cached, and shared between the callers.
+    """
+    content_hash = binary_hash(serialized_block)
+    block = decoded_block_cache.get(content_hash)
+    if block is not None:
+        return block
+
     as_tuple = msgpack.unpackb(serialized_block, encoding="utf-8")
     index, fingers, items, aux = as_tuple
-    return Block(items, index, fingers, aux)
+    block = DecodedBlock(items, index, fingers, aux)
+    decoded_block_cache[content_hash] = block
+    return block
 
 
 def latest_timestamp_resolution_policy(agent, views):
@@ -49,54 +115,190 @@ def latest_timestamp_resolution_policy(agent, views):
     return max(views, key=lambda view: view.payload.timestamp)
 
 
-def immediate_chain_update_policy(agent, recipients):
-    """Update chain whenever anything relevant to an email is updated.
+def fork_detecting_resolution_policy(agent, views):
+    """Resolution policy that picks the latest view, and checks for forks.
 
-    Check if any of the contacts or capability entries that are relevant
-    to the current message have been updated. If yes, commit a new block with
-    the updates before sending the message.
+    The heads of all other candidate views should be ancestors of the
+    latest head. Heads that diverge from it are recorded as forks. Heads
+    whose ancestry can not be traced with the known blocks are not.
     """
+    latest_view = latest_timestamp_resolution_policy(agent, views)
+    if len(views) < 2:
+        return latest_view
+
+    ancestry_index = agent._writable('ancestry_index', AncestryIndex)
+    for view in views:
+        ancestry_index.add(view.chain.head, view._latest_block)
+
+    latest_head = latest_view.chain.head
+    for view in views:
+        head = view.chain.head
+        if head == latest_head or head in agent.forked_heads:
+            continue
+        if ancestry_index.is_fork(head, latest_head, agent.gossip_store):
+            logger.debug('%s / fork / %s', agent.email, head)
+            agent._writable('forked_heads', set).add(head)
+    return latest_view
 
-    # * Update chain if any public cap needs to be updated
+
+def _has_relevant_updates(agent, recipients):
+    """Check if anything that is shared with the recipients is queued."""
+
+    # * Public caps that need to be updated
     if agent.queued_caps.get(PUBLIC_READER_LABEL):
         return True
 
-    public_contacts = agent.committed_caps.get(PUBLIC_READER_LABEL) or set()
+    public_contacts = agent.committed_caps.get(PUBLIC_READER_LABEL) or EMPTY_SET
 
-    # * Update chain if any relevant private cap needs to be updated
+    # * Relevant private caps that need to be updated
     for recipient in recipients:
         if agent.queued_caps.get(recipient):
             return True
 
+    # * Caps of groups that include any of the recipients
+    for reader, contacts in agent.queued_caps.items():
+        group = agent.groups.get(reader)
+        if group is not None and contacts and \
+                not group.members.isdisjoint(recipients):
+            return True
+
     private_contacts = set()
     for recipient in recipients:
-        recipient_caps = agent.committed_caps.get(recipient) or set()
+        recipient_caps = agent.committed_caps.get(recipient) or EMPTY_SET
         private_contacts.update(recipient_caps)
+        # Contacts that are accessible through the recipient's groups.
+        for contact in recipient_caps:
+            if contact in agent.groups:
+                private_contacts.update(
+                        agent.committed_caps.get(contact) or EMPTY_SET)
 
-    # * Update chain if any contact that is to be shared in this
-    # message was updated.
+    # * Contacts that are to be shared in this message, and were updated
     relevant_contacts = private_contacts | public_contacts
-    if len(relevant_contacts.intersection(agent.queued_views)) > 0:
-        return True
+    return len(relevant_contacts.intersection(agent.queued_views)) > 0
+
+
+def immediate_chain_update_policy(agent, recipients, mtime=None):
+    """Update chain whenever anything relevant to an email is updated.
+
+    Check if any of the contacts or capability entries that are relevant
+    to the current message have been updated. If yes, commit a new block with
+    the updates before sending the message.
+    """
+    return _has_relevant_updates(agent, recipients)
+
+
+def buffered_chain_update_policy(agent, recipients, mtime=None):
+    """Update chain once enough updates have been queued.
+
+    Relevant updates are held back until the number of queued updates
+    reaches ``AgentSettings.chain_update_buffer_size``.
+    """
+    buffer_size = AgentSettings.get_default().chain_update_buffer_size
+    return agent.nb_queued_updates >= buffer_size and \
+           _has_relevant_updates(agent, recipients)
+
+
+def windowed_chain_update_policy(agent, recipients, mtime=None):
+    """Update chain at most once per time window.
+
+    Relevant updates are held back until ``AgentSettings.chain_update_window``
+    seconds have passed since the last commit.
+    """
+    window = AgentSettings.get_default().chain_update_window
+    if agent.time_of_last_commit is not None and mtime is not None and \
+            mtime - agent.time_of_last_commit < window:
+        return False
+    return _has_relevant_updates(agent, recipients)
+
+
+def staleness_bound_chain_update_policy(agent, recipients, mtime=None):
+    """Update chain once the oldest queued update gets too stale.
+
+    Any queued update, relevant to the current email or not, is committed
+    at most ``AgentSettings.chain_update_max_staleness`` seconds after it
+    was queued, but only when the agent sends an email.
+    """
+    max_staleness = AgentSettings.get_default().chain_update_max_staleness
+    if agent.time_of_first_queued_update is None or mtime is None:
+        return False
+    return mtime - agent.time_of_first_queued_update >= max_staleness
 
 
 def implicit_cc_introduction_policy(agent, recipient_emails):
-    """Access control policy that gives capabilities to all recipients."""
-    for recipient_email in recipient_emails - {agent.email}:
+    """Access control policy that gives capabilities to all recipients.
+
+    If ``AgentSettings.group_capability_min_size`` is set, emails to at
+    least that many recipients may grant the capabilities to a group of
+    the recipients instead (see :py:meth:`Agent.add_expected_group`).
+    """
+    min_group_size = AgentSettings.get_default().group_capability_min_size
+    readers = recipient_emails - {agent.email}
+    if min_group_size is not None and len(readers) >= min_group_size:
+        agent.add_expected_group(recipient_emails)
+        return
+
+    for recipient_email in readers:
         # NOTE: Friends should be able to see what my belief about them is,
         # so no need to exclude recipient_email from recipient_emails here.
         agent.add_expected_reader(recipient_email, recipient_emails)
 
 
 def public_contacts_policy(agent, recipient_emails):
-    """Access control policy that makes all claims public."""
-    new_public_contacts = set() \
-                        | agent.committed_views.keys() \
-                        | agent.queued_views.keys()    \
-                        | agent.expected_views.keys()
-    for contact in new_public_contacts:
-        agent.queued_views[contact] = agent.get_latest_view(contact)
-    agent.queued_caps[PUBLIC_READER_LABEL] |= new_public_contacts
+    """Access control policy that makes all claims public.
+
+    Only the contacts that have new evidence since the last email, or are
+    newly known, are resolved again. Their views are queued if they
+    differ from the committed ones.
+    """
+    updated_contacts = agent.updated_contacts
+    agent.updated_contacts = EMPTY_SET
+
+    new_public_contacts = set()
+    for contact in updated_contacts:
+        view = agent.get_latest_view(contact)
+        if view is None:
+            continue
+        if view != agent.committed_views.get(contact):
+            agent.queue_view(contact, view)
+        new_public_contacts.add(contact)
+    agent.queue_caps(PUBLIC_READER_LABEL, new_public_contacts)
+
+
+@attrs
+class Group(object):
+    """Recipients of an email that share capabilities through a group key.
+
+    The owner of a chain grants the capabilities for the members' claims
+    to the group's DH key, and puts the group's private key into a claim
+    that only the members can read. Each member then needs one capability
+    instead of one per member.
+    """
+    members = attrib()
+    params = attrib(default=None)
+
+
+def get_group_label(members):
+    """Claim label of the group key of the given members."""
+    digest = sha256('|'.join(sorted(members)).encode('utf-8')).hexdigest()
+    return GROUP_LABEL_PREFIX + digest[:32]
+
+
+def find_group_label(groups, members):
+    """Find the smallest of the groups that has all the given members.
+
+    Members of such a group can already read each other's claims through
+    it, so it can stand in for a group of just the given members.
+
+    :param dict groups: Groups by labels
+    :param members: Members to look for
+    :returns: Label of the group, or None
+    """
+    candidates = [(len(group.members), group_label)
+                  for group_label, group in groups.items()
+                  if group.members >= members]
+    if not candidates:
+        return None
+    return min(candidates)[1]
 
 
 @attrs
@@ -107,6 +309,106 @@ class MessageMetadata(object):
     store = attrib()
 
 
+_FRAME_HEADER = struct.Struct('>I')
+
+
+def encode_message(message_metadata):
+    """Encode message metadata into one contiguous buffer, as it is sent.
+
+    The buffer is a msgpack header with the sender's head, public contacts,
+    object keys, and object sizes, followed by the msgpack encodings of
+    the objects. The header is prefixed with its size.
+
+    :param message_metadata: ``MessageMetadata`` object
+    :returns: Encoded bytes
+    """
+    object_keys = list(message_metadata.store.keys())
+    encoded_objects = [
+            msgpack.packb(serialize_object(message_metadata.store[key]),
+                          use_bin_type=True, encoding="utf-8")
+            for key in object_keys]
+    header = [message_metadata.head,
+              sorted(message_metadata.public_contacts),
+              object_keys,
+              [len(encoded_object) for encoded_object in encoded_objects]]
+    header = msgpack.packb(header, use_bin_type=True, encoding="utf-8")
+    return b''.join([_FRAME_HEADER.pack(len(header)), header]
+                    + encoded_objects)
+
+
+def _decode_object(encoded_object):
+    obj = msgpack.unpackb(encoded_object, encoding="utf-8")
+    if isinstance(obj, bytes):
+        return Blob(obj)
+    elif len(obj) == 2:
+        key, item = obj
+        return Leaf(item, key)
+    elif len(obj) == 3:
+        return Branch(*obj)
+    index, fingers, items, aux = obj
+    return DecodedBlock(items, index, fingers, aux)
+
+
+def decode_message(buffer):
+    """Decode message metadata from a buffer made by :py:func:`encode_message`.
+
+    Objects are decoded from memoryview slices of the buffer, without
+    copying their encodings first. Unlike :py:func:`deserialize_block`,
+    nothing is shared with other decoders, so every recipient pays for
+    decoding the full message.
+
+    :param buffer: Encoded bytes
+    :returns: ``MessageMetadata`` object
+    """
+    view = memoryview(buffer)
+    header_size, = _FRAME_HEADER.unpack_from(view)
+    offset = _FRAME_HEADER.size + header_size
+    header = msgpack.unpackb(
+            view[_FRAME_HEADER.size:offset], encoding="utf-8")
+    head, public_contacts, object_keys, object_sizes = header
+
+    store = {}
+    for key, size in zip(object_keys, object_sizes):
+        store[key] = _decode_object(view[offset:offset + size])
+        offset += size
+    return MessageMetadata(head, set(public_contacts), store)
+
+
+def make_view(chain, view_cls=View):
+    """Make a view of a chain, decoding each head only once.
+
+    The head block, its payload, and the owner's params are decoded by
+    the first view of a head, and shared by all later views of the same
+    head. Each view still uses the current params as the viewer's ones,
+    and reads the tree from the given chain's store. Tree nodes that have
+    been verified by earlier lookups are not re-hashed, so looking up
+    several claims only verifies the union of their paths.
+
+    :param hippiehug.Chain chain: Chain to view
+    :param view_cls: View class of the backend in use
+    """
+    cache_key = (view_cls, chain.head)
+    decoded_head = decoded_view_cache.get(cache_key)
+    if decoded_head is None:
+        view = view_cls(chain)
+        decoded_view_cache[cache_key] = (
+                view._latest_block, view._nonce, view.payload, view.params)
+    else:
+        latest_block, nonce, payload, params = decoded_head
+        view = view_cls.__new__(view_cls)
+        view._viewer_params = LocalParams.get_default()
+        view.chain = chain
+        view._latest_block = latest_block
+        view._nonce = nonce
+        view.payload = payload
+        view.params = params
+
+    if view.payload.mtr_hash is not None:
+        view.tree = Tree(object_store=VerifiedObjectStore(chain.store),
+                         root_hash=ascii2bytes(view.payload.mtr_hash))
+    return view
+
+
 @with_default_context(use_empty_init=True)
 @attrs
 class AgentSettings(object):
@@ -117,50 +419,134 @@ class AgentSettings(object):
     key_update_every_nb_sent_emails = attrib(default=None)
     key_update_every_nb_days = attrib(default=None)
     optimize_sent_objects = attrib(default=True)
+    gossip_store_gc_threshold = attrib(default=None)
+    reuse_encodings = attrib(default=False)
+    group_capability_min_size = attrib(default=None)
+    fast_backend = attrib(default=False)
+    chain_update_buffer_size = attrib(default=5)
+    chain_update_window = attrib(default=24 * 60 * 60)
+    chain_update_max_staleness = attrib(default=24 * 60 * 60)
+
+
+def _set_by_key():
+    return defaultdict(set)
 
 
 class Agent(object):
     """
     Simulated ClaimChain user.
+
+    Containers start out as shared empty sentinels, and are only created
+    once something is written to them.
+
+    :param email: Identifier of the user
+    :param pool_gossip_objects: Whether to keep the objects of the gossip
+                                store in the shared object pool. Only
+                                needed if agents get copies of the same
+                                objects, i.e., if they are reloaded or
+                                decode messages themselves.
     """
-    def __init__(self, email):
+    __slots__ = [
+        'email', 'params', 'chain_store', 'tree_store', 'chain', 'state',
+        'nb_sent_emails', 'nb_evicted_gossip_objects', 'nb_commits',
+        'date_of_last_key_update', 'time_of_last_commit',
+        'time_of_first_queued_update', 'committed_caps', 'committed_views',
+        'queued_identity_info', 'queued_caps', 'queued_views',
+        'expected_caps', 'expected_views', 'committed_claim_heads',
+        'reader_dh_pks', 'granted_caps', 'sender_heads', 'claim_lookups',
+        'global_views', 'contacts_by_sender', 'updated_contacts',
+        'groups', 'groups_by_sender', 'ancestry_index', 'forked_heads',
+        'sent_object_keys_to_recipients', 'gossip_store',
+        'gossip_store_gc_size',
+    ]
+
+    def __init__(self, email, pool_gossip_objects=False):
         self.email = email
-        self.params = LocalParams.generate()
         self.chain_store = ObjectStore()
         self.tree_store = ObjectStore()
         self.chain = Chain(self.chain_store)
-        self.state = State()
+        if AgentSettings.get_default().fast_backend:
+            self.params = FastParams.generate()
+        else:
+            self.params = LocalParams.generate()
+        self.state = self._make_state()
 
         # Stats
         self.nb_sent_emails = 0
+        self.nb_evicted_gossip_objects = 0
+        self.nb_commits = 0
         self.date_of_last_key_update = None
+        self.time_of_last_commit = None
+        # Time when the oldest of the currently queued updates was queued.
+        self.time_of_first_queued_update = None
 
         # Committed views and capabilities
-        self.committed_caps = {}
-        self.committed_views = {}
+        self.committed_caps = EMPTY_DICT
+        self.committed_views = EMPTY_DICT
         # ...and the ones queued to be committed.
         self.queued_identity_info = None
-        self.queued_caps = defaultdict(set)
-        self.queued_views = {}
+        self.queued_caps = EMPTY_DICT
+        self.queued_views = EMPTY_DICT
         # Capabilities for unknown yet contacts
         # and views that have no readers.
-        self.expected_caps = defaultdict(set)
-        self.expected_views = defaultdict(set)
+        self.expected_caps = EMPTY_DICT
+        self.expected_views = EMPTY_DICT
+
+        # Heads that are currently serialized into the state as claims.
+        self.committed_claim_heads = EMPTY_DICT
+        # Reader DH keys resolved during previous commits, and the keys
+        # and number of contacts that have been granted to each reader.
+        self.reader_dh_pks = EMPTY_DICT
+        self.granted_caps = EMPTY_DICT
+
+        # Last seen head of each sender, and results of looking up
+        # claims in those heads by labels: the contacts' heads, or None
+        # for failed lookups of contacts and group keys.
+        self.sender_heads = EMPTY_DICT
+        self.claim_lookups = EMPTY_DICT
 
         # Known beliefs of other people about other people.
-        self.global_views = defaultdict(dict)
+        self.global_views = EMPTY_DICT
         # Contacts that senders have made available to this agent.
-        self.contacts_by_sender = defaultdict(set)
+        self.contacts_by_sender = EMPTY_DICT
+        # Contacts with new evidence since the last sent email, if the
+        # public contacts policy is used.
+        self.updated_contacts = EMPTY_SET
+
+        # Own groups by labels, and groups of other people that this
+        # agent is a member of, by senders and labels.
+        self.groups = EMPTY_DICT
+        self.groups_by_sender = EMPTY_DICT
+
+        # Heights and skip links of known blocks, and the heads that were
+        # found to fork from the resolved ones.
+        self.ancestry_index = EMPTY_DICT
+        self.forked_heads = EMPTY_SET
 
         # Objects that were sent to each recipient.
-        self.sent_object_keys_to_recipients = {}
+        self.sent_object_keys_to_recipients = EMPTY_DICT
         # Objects that were received from other people.
-        self.gossip_store = ObjectStore()
+        if pool_gossip_objects:
+            self.gossip_store = PooledObjectStore()
+        else:
+            self.gossip_store = EvictableObjectStore()
+        # Gossip store size that triggers the next garbage collection.
+        self.gossip_store_gc_size = None
 
         # Generate initial encryption key, and add first block
         # to the chain
         self.update_key()
 
+    @staticmethod
+    def _make_state():
+        settings = AgentSettings.get_default()
+        if settings.fast_backend:
+            return FastState()
+        elif settings.reuse_encodings:
+            return CachingState()
+        else:
+            return BatchState()
+
     @property
     def head(self):
         """Chain head."""
@@ -181,6 +567,45 @@ class Agent(object):
         # 4096 random bits in base64
         return base64.b64encode(os.urandom(4096 // 8))
 
+    @property
+    def view_cls(self):
+        """View class of the backend of this agent."""
+        if isinstance(self.params, FastParams):
+            return FastView
+        return View
+
+    @property
+    def nb_queued_updates(self):
+        """Number of queued views and capabilities."""
+        return len(self.queued_views) + sum(
+                len(contacts) for contacts in self.queued_caps.values())
+
+    @property
+    def nb_nonce_reuses(self):
+        """Number of commits that reused the nonce of the previous block."""
+        return self.state.nb_nonce_reuses
+
+    @property
+    def nb_detected_forks(self):
+        """Number of heads that were found to fork from resolved ones."""
+        return len(self.forked_heads)
+
+    def _writable(self, name, factory=dict):
+        """Get a container for writing, replacing the shared empty one."""
+        container = getattr(self, name)
+        if container is EMPTY_DICT or container is EMPTY_SET:
+            container = factory()
+            setattr(self, name, container)
+        return container
+
+    def queue_view(self, contact, view):
+        """Queue a view of the contact to be committed."""
+        self._writable('queued_views')[contact] = view
+
+    def queue_caps(self, reader, contacts):
+        """Queue capabilities for the reader to be committed."""
+        self._writable('queued_caps', _set_by_key)[reader].update(contacts)
+
     def add_expected_reader(self, reader, contacts):
         """
         Make contacts accessible to the reader.
@@ -199,7 +624,77 @@ class Agent(object):
 
         logger.debug('%s / expected cap / %s: %s', self.email,
                     reader, contacts)
-        self.expected_caps[reader].update(contacts)
+        self._writable('expected_caps', _set_by_key)[reader].update(contacts)
+
+    def add_expected_group(self, members):
+        """
+        Make all members' claims accessible to the members through a group.
+
+        An existing group that has all the members is reused. Otherwise,
+        the group key is created along with its claim, unless granting the
+        capabilities per pair is cheaper, as it is when the members can
+        already read most of each other's claims. As with
+        :py:meth:`add_expected_reader`, the capabilities are queued once
+        the views are known.
+        """
+        members = frozenset(members)
+        group_label = find_group_label(self.groups, members)
+        if group_label is None:
+            # A new group takes a claim for its key, and two capabilities
+            # per member. Grant the capabilities per pair if that is not
+            # more expensive.
+            readers = members - {self.email}
+            nb_pairwise_caps = sum(
+                    len(members - self._get_granted_contacts(reader))
+                    for reader in readers)
+            if nb_pairwise_caps <= 2 * len(members) + GROUP_KEY_CLAIM_COST:
+                for reader in readers:
+                    self.add_expected_reader(reader, members)
+                return
+            group_label = get_group_label(members)
+            params = type(self.params)(dh=type(self.params).generate().dh)
+            self._writable('groups')[group_label] = Group(members, params)
+            self.state[group_label] = msgpack.packb(
+                    params.private_export(), use_bin_type=True)
+
+        logger.debug('%s / expected group / %s', self.email, members)
+        self._writable('expected_caps', _set_by_key)[group_label].update(
+                members)
+        for member in members - {self.email}:
+            self._writable('expected_caps', _set_by_key)[member].add(
+                    group_label)
+
+    def _get_granted_contacts(self, reader):
+        """Contacts that are or will be accessible to the reader."""
+        granted_contacts = set()
+        for caps in [self.expected_caps, self.queued_caps,
+                     self.committed_caps]:
+            granted_contacts.update(caps.get(reader, EMPTY_SET))
+        for group_label in granted_contacts & self.groups.keys():
+            for caps in [self.expected_caps, self.queued_caps,
+                         self.committed_caps]:
+                granted_contacts.update(caps.get(group_label, EMPTY_SET))
+        return granted_contacts
+
+    def _get_group_params(self, view, group_label, group):
+        """Decode the key of a group from the group owner's view.
+
+        Failed lookups are recorded per view head, along with the contact
+        lookups.
+        """
+        if group.params is None:
+            lookups = self._writable('claim_lookups').setdefault(
+                    view.head, {})
+            if group_label in lookups:
+                return None
+            with self.params.as_default():
+                exported = view.get(group_label)
+            if exported is None:
+                lookups[group_label] = None
+                return None
+            group.params = type(self.params).from_dict(
+                    msgpack.unpackb(exported, encoding='utf-8'))
+        return group.params
 
     def _update_buffer(self):
         """Update claim 'expected' and 'queued' buffers.
@@ -214,27 +709,43 @@ class Agent(object):
 
         for reader, contacts in self.expected_caps.items():
             reader_view = self.get_latest_view(reader)
-            if reader_view is None and reader != PUBLIC_READER_LABEL:
+            if reader_view is None and reader != PUBLIC_READER_LABEL \
+                    and reader not in self.groups:
                 continue
 
             for contact in contacts:
+                # Group keys are always available to be shared.
+                if contact in self.groups:
+                    self.queue_caps(reader, [contact])
+                    accepted_caps_by_reader[reader].add(contact)
+                    continue
+
                 contact_view = self.get_latest_view(contact)
                 if contact_view is not None:
                     # Copy expected cap into queue.
-                    self.queued_caps[reader].add(contact)
+                    self.queue_caps(reader, [contact])
 
                     # Move the expected view into queue if needed.
                     if contact in self.expected_views:
-                        self.queued_views[contact] = contact_view
+                        self.queue_view(contact, contact_view)
                         del self.expected_views[contact]
 
                     accepted_caps_by_reader[reader].add(contact)
 
-            # Move the reader view into queue if needed.
+            # Move the reader view into queue if needed. Capabilities
+            # for a group refresh the views of all of its members, as the
+            # capabilities for each of them would.
             if accepted_caps_by_reader[reader]:
-                if reader in self.expected_views:
-                    self.queued_views[reader] = reader_view
-                    del self.expected_views[reader]
+                if reader in self.groups:
+                    members = self.groups[reader].members - {self.email}
+                    views_by_reader = {member: self.get_latest_view(member)
+                                       for member in members}
+                else:
+                    views_by_reader = {reader: reader_view}
+                for member, member_view in views_by_reader.items():
+                    if member in self.expected_views:
+                        self.queue_view(member, member_view)
+                        del self.expected_views[member]
 
         # Clean empty expected_caps entries.
         for reader, contacts in accepted_caps_by_reader.items():
@@ -261,7 +772,8 @@ class Agent(object):
                         | set(self.expected_views.keys())
         views_by_friend = {}
         for friend in current_friends - {contact, self.email}:
-            candidate_view = self.global_views[friend].get(contact)
+            candidate_view = self.global_views.get(
+                    friend, EMPTY_DICT).get(contact)
             if candidate_view is not None:
                 views_by_friend[friend] = candidate_view
 
@@ -288,7 +800,7 @@ class Agent(object):
         # Resolve conflicts using a policy
         view = policy(self, candidate_views)
         # ...and add the resolved view to the 'expected' buffer.
-        self.expected_views[contact] = view
+        self._writable('expected_views')[contact] = view
 
         # Remove from the buffer if the resolved view is the same as committed.
         if save:
@@ -324,6 +836,9 @@ class Agent(object):
 
             # Move expected views and caps into the queue.
             self._update_buffer()
+            if self.time_of_first_queued_update is None and \
+                    self.nb_queued_updates > 0:
+                self.time_of_first_queued_update = mtime
 
             # Decide whether to update the encryption key.
             # TODO: Make key update decision a policy.
@@ -354,39 +869,12 @@ class Agent(object):
             else:
                 # Decide whether to update the chain.
                 update_policy = AgentSettings.get_default().chain_update_policy
-                if update_policy(self, recipients):
-                    self.update_chain()
+                if update_policy(self, recipients, mtime):
+                    self.update_chain(mtime)
 
-            local_object_keys = set()
-
-            # Add own chain blocks.
-            # NOTE: Requires that chain and tree use separate stores
-            local_object_keys.update(self.chain_store.keys())
-
-            # Add authentication proofs for public claims.
             public_contacts = self.committed_caps.get(PUBLIC_READER_LABEL) \
-                              or set()
-            for contact in public_contacts:
-                object_keys = self.state.compute_evidence_keys(
-                        PUBLIC_READER_PARAMS.dh.pk, contact)
-                local_object_keys.update(object_keys)
-                contact_view = self.committed_views.get(contact)
-
-            # Find a minimal amount of proof nodes that need to be included.
-            for recipient in recipients:
-                accessible_contacts = self.committed_caps.get(recipient) \
-                                      or set()
-                for contact in accessible_contacts:
-                    recipient_view = self.committed_views.get(recipient)
-                    if recipient_view is None:
-                        continue
-                    contact_view = self.committed_views.get(contact)
-                    if contact_view is not None:
-                        # Add the proof for the cross-reference.
-                        recipient_dh_pk = recipient_view.params.dh.pk
-                        proof_keys = self.state.compute_evidence_keys(
-                                recipient_dh_pk, contact)
-                        local_object_keys.update(proof_keys)
+                              or EMPTY_SET
+            local_object_keys = self._get_local_object_keys(recipients)
 
             # Find the minimal amount of objects that need to be sent in
             # this message.
@@ -395,8 +883,8 @@ class Agent(object):
             for recipient in recipients:
                 if recipient not in self.sent_object_keys_to_recipients:
                     if AgentSettings.get_default().optimize_sent_objects:
-                        self.sent_object_keys_to_recipients[recipient] = \
-                                relevant_keys
+                        self._writable('sent_object_keys_to_recipients')[
+                                recipient] = relevant_keys
                     object_keys_to_send = relevant_keys
                 else:
                     object_keys_for_recipient = relevant_keys.difference(
@@ -415,13 +903,67 @@ class Agent(object):
             return MessageMetadata(
                     self.chain.head, public_contacts, message_store)
 
+    def _get_local_object_keys(self, recipients):
+        """Collect keys of own blocks, and of claim proofs for recipients."""
+        local_object_keys = set()
+
+        # Add own chain blocks.
+        # NOTE: Requires that chain and tree use separate stores
+        local_object_keys.update(self.chain_store.keys())
+
+        # Add authentication proofs for public claims.
+        public_contacts = self.committed_caps.get(PUBLIC_READER_LABEL) \
+                          or EMPTY_SET
+        for contact in public_contacts:
+            object_keys = self.state.compute_evidence_keys(
+                    PUBLIC_READER_PARAMS.dh.pk, contact)
+            local_object_keys.update(object_keys)
+            contact_view = self.committed_views.get(contact)
+
+        # Find a minimal amount of proof nodes that need to be included.
+        proven_groups = set()
+        for recipient in recipients:
+            accessible_contacts = self.committed_caps.get(recipient) \
+                                  or EMPTY_SET
+            for contact in accessible_contacts:
+                recipient_view = self.committed_views.get(recipient)
+                if recipient_view is None:
+                    continue
+                recipient_dh_pk = recipient_view.params.dh.pk
+                contact_view = self.committed_views.get(contact)
+                if contact_view is not None:
+                    # Add the proof for the cross-reference.
+                    proof_keys = self.state.compute_evidence_keys(
+                            recipient_dh_pk, contact)
+                    local_object_keys.update(proof_keys)
+                elif contact in self.groups:
+                    # Add the proof for the group key...
+                    proof_keys = self.state.compute_evidence_keys(
+                            recipient_dh_pk, contact)
+                    local_object_keys.update(proof_keys)
+                    if contact in proven_groups:
+                        continue
+                    # ...and, once for all members, the proofs for the
+                    # cross-references accessible to the group.
+                    proven_groups.add(contact)
+                    group_dh_pk = self.groups[contact].params.dh.pk
+                    group_contacts = self.committed_caps.get(contact) \
+                                     or EMPTY_SET
+                    for group_contact in group_contacts:
+                        if group_contact in self.committed_views:
+                            proof_keys = self.state.compute_evidence_keys(
+                                    group_dh_pk, group_contact)
+                            local_object_keys.update(proof_keys)
+        return local_object_keys
+
     def get_accessible_contacts(self, sender, message_metadata,
                                 other_recipients=None):
         """
         Get the contacts that are expected to be accessible on sender's chain.
         """
         # NOTE: Assumes other people's introduction policy is the same
-        contacts = self.contacts_by_sender[sender]
+        contacts = self._writable(
+                'contacts_by_sender', _set_by_key)[sender]
         other_recipients = set(other_recipients) - {sender, self.email}
         for recipient in other_recipients | message_metadata.public_contacts:
             contacts.add(recipient)
@@ -441,29 +983,63 @@ class Agent(object):
             other_recipients = set()
 
         with self.params.as_default():
-            # Merge stores temporarily.
-            merged_store = ObjectStore(self.gossip_store)
-            for key, obj in message_metadata.store.items():
-                merged_store[key] = obj
+            # Look up objects in the message first, and in the gossip
+            # store second, without copying either of them.
+            merged_store = OverlayStore(
+                    message_metadata.store, self.gossip_store)
 
             sender_head = message_metadata.head
+            previous_sender_head = self.sender_heads.get(sender)
+            sender_head_changed = previous_sender_head != sender_head
+            if sender_head_changed:
+                if previous_sender_head in self.claim_lookups:
+                    del self.claim_lookups[previous_sender_head]
+                self._writable('sender_heads')[sender] = sender_head
+
             sender_latest_block = merged_store[sender_head]
             self.gossip_store[sender_head] = \
                     sender_latest_block
-            self.expected_views[sender] = View(
-                    Chain(self.gossip_store,
-                          root_hash=sender_head))
-            full_sender_view = View(
-                    Chain(merged_store,
-                          root_hash=sender_head))
+            self._writable('expected_views')[sender] = make_view(
+                    Chain(self.gossip_store, root_hash=sender_head),
+                    self.view_cls)
+            if sender_head_changed and sender in self.reader_dh_pks:
+                del self.reader_dh_pks[sender]
             logger.debug('%s / expected view / %s', self.email, sender)
 
-            # Add relevant objects from the message store.
+            # Expect the claims to be shared with a group if the email is
+            # wide enough. The sender may have granted them per pair
+            # instead, in which case the group key is not found.
+            # NOTE: Assumes other people's introduction policy is the same
+            min_group_size = AgentSettings.get_default() \
+                    .group_capability_min_size
+            members = frozenset(other_recipients) | {self.email}
+            if min_group_size is not None and \
+                    len(members - {sender}) >= min_group_size:
+                sender_groups = self._writable(
+                        'groups_by_sender').setdefault(sender, {})
+                if find_group_label(sender_groups, members) is None:
+                    sender_groups[get_group_label(members)] = Group(members)
+
+            # Add relevant objects from the message store. Contacts that
+            # were looked up in the same sender head can not have
+            # changed, so only the new ones are looked up.
             contacts = self.get_accessible_contacts(
                     sender, message_metadata, other_recipients)
-            for contact in contacts - {self.email}:
+            lookups = self.claim_lookups.get(sender_head, EMPTY_DICT)
+            new_contacts = contacts - lookups.keys() - {self.email}
+            if new_contacts:
+                # Stubs commit their claims with the stand-ins of the
+                # fast backend, so they are looked up with the stand-ins.
+                if sender_latest_block.aux == SIGNATURE_STAND_IN:
+                    sender_view_cls = FastView
+                else:
+                    sender_view_cls = self.view_cls
+                full_sender_view = make_view(
+                        Chain(merged_store, root_hash=sender_head),
+                        sender_view_cls)
+            for contact in new_contacts:
                 contact_latest_block = self.get_contact_head_from_view(
-                        full_sender_view, contact)
+                        full_sender_view, contact, sender)
                 if contact_latest_block is not None:
                     contact_head_hash = contact_latest_block.hid
                     self.gossip_store[contact_head_hash] = contact_latest_block
@@ -471,22 +1047,141 @@ class Agent(object):
                     # NOTE: Assumes people send only contacts' latest blocks
                     contact_chain = Chain(self.gossip_store,
                                           root_hash=contact_head_hash)
-                    self.global_views[sender][contact] = View(contact_chain)
+                    sender_views = self._writable('global_views').setdefault(
+                            sender, {})
+                    sender_views[contact] = make_view(
+                            contact_chain, self.view_cls)
+                    if contact in self.reader_dh_pks:
+                        del self.reader_dh_pks[contact]
 
             # TODO: Needs a special check for contact==self.email.
 
+            # Keep the objects of the message, since senders do not send
+            # the same objects to a recipient twice.
+            for key, obj in message_metadata.store.items():
+                self.gossip_store[key] = obj
+
+            # Index the received blocks before the garbage collection can
+            # evict them, so that forks can be traced through them later.
+            if AgentSettings.get_default().conflict_resolution_policy is \
+                    fork_detecting_resolution_policy:
+                self._index_received_blocks(sender, message_metadata,
+                                            new_contacts)
+
             # Recompute the latest beliefs.
-            for contact in {sender} | contacts:
+            for contact in {sender} | new_contacts:
                 self.get_latest_view(contact)
-
-    def get_contact_head_from_view(self, view, contact):
+            # Only the public contacts policy needs to know which contacts
+            # have new evidence.
+            if AgentSettings.get_default().introduction_policy is \
+                    public_contacts_policy:
+                self._writable('updated_contacts', set).update(
+                        {sender} | new_contacts)
+
+            # Evict superseded objects if the gossip store grew too large.
+            gc_threshold = AgentSettings.get_default().gossip_store_gc_threshold
+            if gc_threshold is not None:
+                gc_size = self.gossip_store_gc_size or gc_threshold
+                if len(self.gossip_store) > gc_size:
+                    self.collect_gossip_garbage()
+                    self.gossip_store_gc_size = max(
+                            gc_threshold, 2 * len(self.gossip_store))
+
+    def _index_received_blocks(self, sender, message_metadata, contacts):
+        """Add the sender's blocks and the contacts' heads to the ancestry
+        index."""
+        ancestry_index = self._writable('ancestry_index', AncestryIndex)
+        ancestry_index.add(message_metadata.head,
+                           self.gossip_store[message_metadata.head])
+        for key, obj in message_metadata.store.items():
+            if isinstance(obj, Block):
+                ancestry_index.add(key, obj)
+        sender_views = self.global_views.get(sender, EMPTY_DICT)
+        for contact in contacts:
+            view = sender_views.get(contact)
+            if view is not None:
+                ancestry_index.add(view.head, view._latest_block)
+
+    def collect_gossip_garbage(self):
+        """Evict objects that no live view refers to from the gossip store.
+
+        Live views are the committed, queued, and expected views, and the
+        views in the known beliefs of other people. Their head blocks, and
+        the tree nodes and values that are reachable from the tree roots
+        of the head blocks are kept. Views never read any other block, so
+        superseded blocks of the same chain are evicted too.
+
+        :returns: Number of evicted objects
         """
-        Try accessing a claim as oneself, and fall back to a public reader.
+        live_views = itertools.chain(
+                self.committed_views.values(),
+                self.queued_views.values(),
+                self.expected_views.values(),
+                *(views.values() for views in self.global_views.values()))
+
+        live_keys = set()
+        keys_to_visit = []
+        for view in live_views:
+            live_keys.add(view.head)
+            if view.payload.mtr_hash is not None:
+                keys_to_visit.append(ascii2bytes(view.payload.mtr_hash))
+
+        while keys_to_visit:
+            key = keys_to_visit.pop()
+            if key in live_keys:
+                continue
+            obj = self.gossip_store.get(key)
+            if obj is None:
+                continue
+            live_keys.add(key)
+            if isinstance(obj, Branch):
+                keys_to_visit.extend([obj.left_branch, obj.right_branch])
+            elif isinstance(obj, Leaf):
+                keys_to_visit.append(obj.item)
+
+        evicted_keys = set(self.gossip_store.keys()) - live_keys
+        for key in evicted_keys:
+            del self.gossip_store[key]
+
+        logger.debug('%s / gossip gc / evicted %d objects', self.email,
+                     len(evicted_keys))
+        self.nb_evicted_gossip_objects += len(evicted_keys)
+        return len(evicted_keys)
+
+    def get_contact_head_from_view(self, view, contact, sender=None):
+        """
+        Try accessing a claim as a member of the view owner's groups, as
+        oneself, and fall back to a public reader.
+
+        Results are recorded per view head, so that receivers do not look
+        up the same contact in the same head again.
 
         :param view: View to query
         :param contact: Contact of interest
+        :param sender: Owner of the view, if known
         :returns: Contact's head block, or None
         """
+        contact_latest_block = self._lookup_contact_head(
+                view, contact, sender)
+        lookups = self._writable('claim_lookups').setdefault(view.head, {})
+        if contact_latest_block is None:
+            lookups[contact] = None
+        else:
+            lookups[contact] = contact_latest_block.hid
+        return contact_latest_block
+
+    def _lookup_contact_head(self, view, contact, sender=None):
+        sender_groups = self.groups_by_sender.get(sender, EMPTY_DICT)
+        for group_label, group in sender_groups.items():
+            if contact not in group.members:
+                continue
+            group_params = self._get_group_params(view, group_label, group)
+            if group_params is None:
+                continue
+            with group_params.as_default():
+                claim = view.get(contact)
+                if claim is not None:
+                    return deserialize_block(claim)
         with self.params.as_default():
             claim = view.get(contact)
             if claim is not None:
@@ -496,10 +1191,12 @@ class Agent(object):
             if claim is not None:
                 return deserialize_block(claim)
 
-    def update_chain(self):
+    def update_chain(self, mtime=None):
         """Force a chain update.
 
         Commits views and capabilities in the queues to the chain.
+
+        :param mtime: Timestamp of the commit, if known
         """
         logger.debug('%s / chain update', self.email)
 
@@ -510,34 +1207,30 @@ class Agent(object):
                 for contact in contacts:
                     self.get_latest_view(contact)
 
-            # Add the latest own encryption key.
-            if self.queued_identity_info is not None:
-                self.state.identity_info = self.queued_identity_info
-
             # Mark queued views as committed.
             for friend, view in self.queued_views.items():
-                self.committed_views[friend] = view
-
-            # Put heads of previously committed views into the state.
-            for friend, view in self.committed_views.items():
-                latest_block = view.chain.store.get(view.head)
-                self.state[friend] = serialize_block(latest_block)
-                self.committed_views[friend] = view
+                self._writable('committed_views')[friend] = view
 
-            # Collect DH keys for all readers.
+            # Collect DH keys for all readers. Keys resolved in previous
+            # commits are reused until new evidence about the reader arrives.
             dh_pk_by_reader = {}
             readers = set(self.queued_caps.keys()) | self.committed_caps.keys()
             for reader in readers:
-                reader_dh_pk = None
+                reader_dh_pk = self.reader_dh_pks.get(reader)
                 # If the buffer is for the public reader:
                 if reader == PUBLIC_READER_LABEL:
                     reader_dh_pk = PUBLIC_READER_PARAMS.dh.pk
 
+                # If the buffer is for an own group:
+                elif reader in self.groups:
+                    reader_dh_pk = self.groups[reader].params.dh.pk
+
                 # Otherwise, try to find the DH key in views.
-                else:
+                elif reader_dh_pk is None:
                     view = self.get_latest_view(reader, save=False)
                     if view is not None:
                         reader_dh_pk = view.params.dh.pk
+                        self._writable('reader_dh_pks')[reader] = reader_dh_pk
 
                 if reader_dh_pk is not None:
                     dh_pk_by_reader[reader] = reader_dh_pk
@@ -549,20 +1242,56 @@ class Agent(object):
                 if reader in self.committed_caps:
                     self.committed_caps[reader].update(contacts)
                 else:
-                    self.committed_caps[reader] = set(contacts)
-
-            for reader, reader_dh_pk in dh_pk_by_reader.items():
-                contacts = self.committed_caps.get(reader)
-                if contacts:
-                    self.state.grant_access(reader_dh_pk, contacts)
+                    self._writable('committed_caps')[reader] = set(contacts)
 
             # Commit state.
-            head = self.state.commit(target_chain=self.chain,
-                                     tree_store=self.tree_store)
+            self._commit_state(dh_pk_by_reader)
 
             # Flush the view and caps queues.
-            self.queued_views.clear()
-            self.queued_caps.clear()
+            self.queued_views = EMPTY_DICT
+            self.queued_caps = EMPTY_DICT
+            self.time_of_first_queued_update = None
+
+            self.nb_commits += 1
+            if mtime is not None:
+                self.time_of_last_commit = mtime
+
+    def _commit_state(self, dh_pk_by_reader):
+        """Put the committed views and capabilities into a new block.
+
+        :param dict dh_pk_by_reader: DH keys of the readers that are known
+        """
+        # Add the latest own encryption key.
+        if self.queued_identity_info is not None:
+            self.state.identity_info = self.queued_identity_info
+
+        # Put heads of committed views into the state, unless they are
+        # already there.
+        for friend, view in self.committed_views.items():
+            if self.committed_claim_heads.get(friend) == view.head:
+                continue
+            latest_block = view.chain.store.get(view.head)
+            self.state[friend] = serialize_block(latest_block, view.head)
+            self._writable('committed_claim_heads')[friend] = view.head
+
+        # Only pass on capabilities that changed since the last commit.
+        # Committed capabilities only grow, so the number of contacts
+        # identifies the granted set.
+        for reader, reader_dh_pk in dh_pk_by_reader.items():
+            contacts = self.committed_caps.get(reader)
+            if not contacts:
+                continue
+            granted = (reader_dh_pk, len(contacts))
+            previously_granted = self.granted_caps.get(reader)
+            if previously_granted != granted:
+                # Drop the shared secret if the reader's key changed.
+                if previously_granted is not None and \
+                        previously_granted[0] != reader_dh_pk:
+                    self.state.clear_shared_secrets(previously_granted[0])
+                self.state.grant_access(reader_dh_pk, contacts)
+                self._writable('granted_caps')[reader] = granted
+
+        self.state.commit(target_chain=self.chain, tree_store=self.tree_store)
 
     def update_key(self, mtime=None):
         """
@@ -570,10 +1299,37 @@ class Agent(object):
         """
         logger.debug('%s / key update', self.email)
         self.queued_identity_info = Agent.generate_public_key()
-        self.update_chain()
+        self.state.clear_shared_secrets()
+        if isinstance(self.state, CachingState):
+            self.state.clear_cache()
+        self.update_chain(mtime)
         if mtime is not None:
             self.date_of_last_key_update = datetime.fromtimestamp(mtime)
 
     def __repr__(self):
         return 'Agent("%s")' % self.email
 
+
+class StubAgent(Agent):
+    """Simulated user outside of the studied set of users.
+
+    Receives, relays, and introduces contacts as a full agent would, but
+    commits with the crypto-free stand-ins of the fast backend (see
+    :py:mod:`simulations.fast`). The stand-ins have the real sizes, so the
+    messages and stores of other agents are the same as with a full
+    agent. Other agents look up the stub's claims with the stand-ins.
+    Only the tree of the latest block is kept.
+    """
+    __slots__ = []
+
+    @staticmethod
+    def _make_state():
+        return FastState()
+
+    def _commit_state(self, dh_pk_by_reader):
+        # Proofs are only sent for the latest tree.
+        self.tree_store = ObjectStore()
+        super(StubAgent, self)._commit_state(dh_pk_by_reader)
+
+    def __repr__(self):
+        return 'StubAgent("%s")' % self.email
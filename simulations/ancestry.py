@@ -0,0 +1,90 @@
+"""
+Ancestry index of chain blocks, to detect forks
+"""
+
+
+class AncestryIndex(dict):
+    """Heights and skip links of chain blocks, by block hashes.
+
+    Every block links back to its predecessor, and to earlier blocks at
+    exponentially growing distances (its ``fingers``), so ancestry queries
+    take a logarithmic number of steps in the distance between the blocks.
+    Blocks stay indexed after they are evicted from the stores they were
+    read from. Blocks that are only known from the fingers of indexed
+    blocks are indexed by heights only.
+    """
+
+    def add(self, block_hash, block):
+        """Index a block, and the heights of the blocks it links to."""
+        entry = self.get(block_hash)
+        if entry is not None and entry[1] is not None:
+            return
+        fingers = tuple((index, finger_hash)
+                        for index, finger_hash in block.fingers)
+        self[block_hash] = (block.index, fingers)
+        for index, finger_hash in fingers:
+            if finger_hash not in self:
+                self[finger_hash] = (index, None)
+
+    def get_height(self, block_hash):
+        """Height of a block, or None if the block is unknown."""
+        entry = self.get(block_hash)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def _get_fingers(self, block_hash, store):
+        entry = self.get(block_hash)
+        if entry is not None and entry[1] is not None:
+            return entry[1]
+        if store is None:
+            return None
+        try:
+            block = store[block_hash]
+        except KeyError:
+            return None
+        self.add(block_hash, block)
+        return self[block_hash][1]
+
+    def is_ancestor(self, ancestor_hash, descendant_hash, store=None):
+        """Check if a block is on the chain that ends with another block.
+
+        Blocks count as their own ancestors.
+
+        :param ancestor_hash: Hash of the supposed ancestor
+        :param descendant_hash: Hash of the supposed descendant
+        :param store: Store to read blocks that are not indexed yet from
+        :returns: True or False, or None if a block on the way back from
+                  the descendant is unknown
+        """
+        target_height = self.get_height(ancestor_hash)
+        height = self.get_height(descendant_hash)
+        if target_height is None or height is None:
+            return None
+
+        block_hash = descendant_hash
+        while height > target_height:
+            fingers = self._get_fingers(block_hash, store)
+            if fingers is None:
+                return None
+            # Jump to the earliest linked block that is not below the target.
+            height, block_hash = min(
+                    (index, finger_hash) for index, finger_hash in fingers
+                    if index >= target_height)
+        return block_hash == ancestor_hash
+
+    def is_fork(self, first_hash, second_hash, store=None):
+        """Check if two blocks are on diverging chains.
+
+        :returns: True or False, or None if it can not be decided
+        """
+        first_height = self.get_height(first_hash)
+        second_height = self.get_height(second_hash)
+        if first_height is None or second_height is None:
+            return None
+        if first_height > second_height:
+            first_hash, second_hash = second_hash, first_hash
+        is_ancestor = self.is_ancestor(first_hash, second_hash, store)
+        if is_ancestor is None:
+            return None
+        return not is_ancestor
@@ -0,0 +1,222 @@
+"""
+Crypto-free stand-ins for ClaimChain params, states, and views.
+
+Stand-ins have the same access semantics as the real ClaimChain: a reader
+can only find a claim if the owner has granted them a capability for it.
+Nothing is encrypted or signed, but all encoded objects have the same
+serialized sizes as the real ones.
+"""
+
+import os
+
+from hashlib import sha256
+
+from petlib.pack import encode, decode
+from claimchain import LocalParams, View
+from claimchain.core import _compute_claim_key, _salt_label
+from claimchain.crypto import Keypair, PublicParams, compute_vrf, sign
+from claimchain.state import cached_property
+from claimchain.utils import ascii2bytes, bytes2ascii, ensure_binary, \
+                             ensure_text, pet2ascii
+
+from .state import BatchState
+
+
+def _sample_encodings():
+    """Get real encodings, to use as templates for the stand-ins."""
+    params = LocalParams.generate()
+    with params.as_default():
+        point_export = params.dh.pk.export()
+        point_header = encode(params.dh.pk)[:-len(point_export)]
+        vrf_proof = compute_vrf(b'sample').proof
+        signature = pet2ascii(sign(b'sample'))
+    return point_header, len(point_export), vrf_proof, signature
+
+
+_POINT_HEADER, _POINT_SIZE, _VRF_PROOF, SIGNATURE_STAND_IN = \
+        _sample_encodings()
+_TAG_SIZE = 16
+
+
+class FakePoint(bytes):
+    """Stand-in for an exported EC point."""
+    def export(self):
+        return bytes(self)
+
+
+def _generate_point():
+    # Same format as compressed EC points.
+    return FakePoint(bytes([2 + os.urandom(1)[0] % 2]) +
+                     os.urandom(_POINT_SIZE - 1))
+
+
+def _point_to_ascii(point):
+    return ensure_text(bytes2ascii(_POINT_HEADER + point))
+
+
+def _ascii_to_point(encoded_point):
+    return FakePoint(ascii2bytes(encoded_point)[len(_POINT_HEADER):])
+
+
+class FastParams(LocalParams):
+    """Stand-in for ``LocalParams`` with random keys instead of EC keys."""
+
+    @staticmethod
+    def generate():
+        """Generate key pairs."""
+        return FastParams(*(Keypair(pk=_generate_point(),
+                                    sk=_generate_point())
+                            for _ in range(4)))
+
+    def _export(self, private=False):
+        result = {}
+        for name in ['vrf', 'sig', 'dh', 'rescue']:
+            keypair = getattr(self, name)
+            if isinstance(keypair, Keypair):
+                result[name + '_pk'] = _point_to_ascii(keypair.pk)
+                if private:
+                    result[name + '_sk'] = _point_to_ascii(keypair.sk)
+        return result
+
+    @staticmethod
+    def from_dict(exported):
+        """Import from dictionary.
+
+        :param dict exported: Exported params
+        """
+        params = FastParams()
+        for name in ['vrf', 'sig', 'dh', 'rescue']:
+            keypair = Keypair(pk=None)
+            if exported.get(name + '_pk') is not None:
+                keypair.pk = _ascii_to_point(exported[name + '_pk'])
+            if exported.get(name + '_sk') is not None:
+                keypair.sk = _ascii_to_point(exported[name + '_sk'])
+            if keypair.pk is not None or keypair.sk is not None:
+                setattr(params, name, keypair)
+        return params
+
+
+def _compute_vrf_value(owner_vrf_pk, salted_label):
+    digest = sha256(owner_vrf_pk.export() + b'|' + salted_label).digest()
+    return bytes([2 + digest[0] % 2]) + digest[1:_POINT_SIZE]
+
+
+def get_capability_lookup_key(owner_dh_pk, nonce, claim_label):
+    """Stand-in for ``claimchain.core.get_capability_lookup_key``.
+
+    The shared secret of the owner and the reader is a hash of both of
+    their public keys, so it can be computed from either side.
+    """
+    pp = PublicParams.get_default()
+    own_dh_pk = LocalParams.get_default().dh.pk
+    shared_secret = b'|'.join(sorted([own_dh_pk.export(),
+                                      owner_dh_pk.export()]))
+    return pp.hash_func(b'cap_lookup|%s|%s|%s' % (
+            ensure_binary(nonce), sha256(shared_secret).digest(),
+            ensure_binary(claim_label))).digest()[:pp.lookup_key_size]
+
+
+def encode_claim(nonce, claim_label, claim_content):
+    """Stand-in for ``claimchain.core.encode_claim``."""
+    salted_label = _salt_label(nonce, claim_label)
+    vrf_value = _compute_vrf_value(
+            LocalParams.get_default().vrf.pk, salted_label)
+    lookup_key = _compute_claim_key(vrf_value, mode='lookup')
+    # Real VRF proofs are randomized, so every encoding is unique.
+    proof = os.urandom(len(_VRF_PROOF))
+    body = encode([proof, ensure_binary(claim_content)])
+    return vrf_value, lookup_key, encode([body, os.urandom(_TAG_SIZE)])
+
+
+def decode_claim(owner_vrf_pk, nonce, claim_label, vrf_value,
+                 encrypted_claim):
+    """Stand-in for ``claimchain.core.decode_claim``."""
+    salted_label = _salt_label(nonce, claim_label)
+    if vrf_value != _compute_vrf_value(owner_vrf_pk, salted_label):
+        raise Exception("Wrong VRF value")
+    body, _ = decode(encrypted_claim)
+    _, claim_content = decode(body)
+    return claim_content
+
+
+def encode_capability(reader_dh_pk, nonce, claim_label, vrf_value):
+    """Stand-in for ``claimchain.core.encode_capability``."""
+    lookup_key = get_capability_lookup_key(reader_dh_pk, nonce, claim_label)
+    # Real encodings differ for every reader.
+    tag = sha256(lookup_key).digest()[:_TAG_SIZE]
+    return lookup_key, encode([vrf_value, tag])
+
+
+def decode_capability(owner_dh_pk, nonce, claim_label, encrypted_capability):
+    """Stand-in for ``claimchain.core.decode_capability``."""
+    vrf_value, _ = decode(encrypted_capability)
+    return vrf_value, _compute_claim_key(vrf_value, mode='lookup')
+
+
+class FastState(BatchState):
+    """ClaimChain owner state that uses the crypto-free stand-ins.
+
+    :param identity_info: Owner's identity info (public key)
+    """
+
+    def __init__(self, identity_info=None):
+        super(FastState, self).__init__(identity_info)
+
+    def _encode_claims(self, nonce):
+        return [(claim_label, encode_claim(nonce, claim_label, claim_content))
+                for claim_label, claim_content
+                in self._claim_content_by_label.items()]
+
+    def _encode_capabilities(self, nonce, batches):
+        return [encode_capability(reader_dh_pk, nonce, claim_label, vrf_value)
+                for reader_dh_pk, batch in batches
+                for claim_label, vrf_value in batch]
+
+    def _sign_block(self, block):
+        block.aux = SIGNATURE_STAND_IN
+
+    def _get_capability_lookup_key(self, reader_dh_pk, claim_label):
+        return get_capability_lookup_key(
+                reader_dh_pk, self._nonce, claim_label)
+
+
+class FastView(View):
+    """View of a chain committed with :py:class:`FastState`."""
+
+    @cached_property
+    def params(self):
+        """Stand-in params of the chain owner."""
+        return FastParams.from_dict(self.payload.metadata.params)
+
+    def _lookup_capability(self, claim_label):
+        cap_lookup_key = get_capability_lookup_key(
+                self.params.dh.pk, self._nonce, claim_label)
+        try:
+            cap = self.tree[cap_lookup_key]
+        except KeyError:
+            raise KeyError("Label does not exist or you don't have "
+                           "permission to read.")
+        except AttributeError:
+            raise ValueError("The chain does not have a claim map.")
+        return decode_capability(self.params.dh.pk, self._nonce,
+                                 claim_label, cap)
+
+    def _lookup_claim(self, claim_label, vrf_value, claim_lookup_key):
+        try:
+            enc_claim = self.tree[claim_lookup_key]
+        except KeyError:
+            raise KeyError("Claim not found, but permission to read the label "
+                           "exists.")
+        except AttributeError:
+            raise ValueError("The chain does not have a claim map.")
+        return decode_claim(self.params.vrf.pk, self._nonce,
+                            claim_label, vrf_value, enc_claim)
+
+    def __getitem__(self, claim_label):
+        # Real viewers read the chains of stubs, so compare the exports.
+        if self._viewer_params.vrf.pk.export() == self.params.vrf.pk.export():
+            vrf_value, claim_lookup_key, _ = encode_claim(
+                    self._nonce, claim_label, "")
+        else:
+            vrf_value, claim_lookup_key = self._lookup_capability(claim_label)
+        return self._lookup_claim(claim_label, vrf_value, claim_lookup_key)
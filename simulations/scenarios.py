@@ -3,17 +3,22 @@ Simulations of ClaimChain key distribution.
 """
 
 import sys
+import time
 import logging
 from collections import defaultdict
 from enum import Enum
 
 import pandas as pd
 
-from attr import asdict
+from attr import asdict, evolve
 from msgpack import packb
 from tqdm import tqdm
 
-from .agent import Agent, AgentSettings
+from .agent import Agent, AgentSettings, StubAgent
+from .agent import encoded_block_cache, decoded_block_cache
+from .agent import decoded_view_cache
+from .agent import encode_message, decode_message
+from .spill import SpillingAgentStore
 from .utils import *
 
 
@@ -21,21 +26,94 @@ logger = logging.getLogger(__name__)
 
 
 class GlobalState(object):
-    """Current state of a simulation at a point in time."""
-    def __init__(self, context):
+    """Current state of a simulation at a point in time.
+
+    :param context: Simulation context
+    :param max_resident_agents: Number of agents to keep in memory, or None
+                                to keep all of them. The rest are spilled
+                                to disk.
+    :param spill_path: Path to the database of spilled agents
+    :param stub_outside_userset: Whether to simulate users outside of the
+                                 userset with stub agents
+    :param payload_compression: Compression method of message payloads
+                                (see :py:class:`PayloadCodec`), or None
+    :param shared_dictionaries: Whether to compress payloads against
+                                per-pair shared dictionaries
+    :param snapshot: Snapshot of a predecessor state to start from
+                     (see :py:func:`load_snapshot`), or None
+    :param wire_messages: Whether to encode messages into buffers, and
+                          decode them on the recipients' side
+    :param record_memory_sizes: Whether to record the memory taken by
+                                each agent at the end of the simulation
+    """
+    def __init__(self, context, max_resident_agents=None, spill_path=None,
+                 stub_outside_userset=False, payload_compression=None,
+                 shared_dictionaries=False, snapshot=None,
+                 wire_messages=False, record_memory_sizes=False):
         self.context = context
-        self.agents = {}
+        self.wire_messages = wire_messages
+        self.record_memory_sizes = record_memory_sizes
+        self.stub_outside_userset = stub_outside_userset
+        # Agents only get copies of the same objects when they are
+        # reloaded, or decode messages themselves.
+        self.pool_gossip_objects = wire_messages or \
+                max_resident_agents is not None
+        self.payload_codec = None
+        if payload_compression is not None:
+            self.payload_codec = PayloadCodec(payload_compression,
+                                              shared_dictionaries)
+        if max_resident_agents is None:
+            self.agents = {}
+        else:
+            self.agents = SpillingAgentStore(max_resident_agents, spill_path)
         self.sent_email_count = 0
         self.encrypted_email_count = 0
-        for user in self.context.senders:
-            self.agents[user] = Agent(user)
         self.recipients_by_sender = defaultdict(set)
 
+        if snapshot is not None:
+            for user, agent in snapshot['agents']:
+                self.add_agent(user, agent)
+            for user, recipients in snapshot['recipients_by_sender'].items():
+                self.recipients_by_sender[user] |= recipients
+        for user in self.context.senders:
+            self.add_agent(user)
+
+    def add_agent(self, user, agent=None):
+        """Add an agent for the user, unless one exists already.
+
+        :param agent: Agent to add, such as one from a snapshot, or None
+                      to create a new one
+        """
+        if user in self.agents:
+            return
+        if agent is not None:
+            self.agents[user] = agent
+        elif self.stub_outside_userset and user not in self.context.userset:
+            self.agents[user] = StubAgent(user, self.pool_gossip_objects)
+        else:
+            self.agents[user] = Agent(user, self.pool_gossip_objects)
+        self.trim_agents()
+
+    def trim_agents(self):
+        """Spill agents that do not fit in memory, if the number is bounded."""
+        if isinstance(self.agents, SpillingAgentStore):
+            self.agents.trim()
+
+    def close(self):
+        """Release the database of spilled agents, if there is one."""
+        if isinstance(self.agents, SpillingAgentStore):
+            self.agents.close()
+
 
 class SimulationReports(object):
     """Simulation results."""
     def __init__(self, context):
         self.encryption_status_data = pd.Series()
+        self.block_encode_cache_hit_rate_data = pd.Series()
+        self.block_decode_cache_hit_rate_data = pd.Series()
+        self.view_cache_hit_rate_data = pd.Series()
+        self.verification_cache_hit_rate_data = pd.Series()
+        self.object_pool_size_data = pd.Series()
         self.participants_type_data = pd.Series()
         self.link_status_data = pd.DataFrame(
                 columns=[opt.name for opt in list(LinkStatus)])
@@ -43,8 +121,25 @@ class SimulationReports(object):
         self.cache_size_data = defaultdict(pd.Series)
         self.local_store_size_data = defaultdict(pd.Series)
         self.gossip_store_size_data = defaultdict(pd.Series)
+        self.gossip_eviction_data = defaultdict(pd.Series)
+        self.chain_commits_data = defaultdict(pd.Series)
+        self.queued_updates_data = defaultdict(pd.Series)
+        # Commits that reused the nonce of the previous block, which
+        # deviates from the protocol (see CachingState).
+        self.nonce_reuse_data = defaultdict(pd.Series)
+        self.detected_forks_data = defaultdict(pd.Series)
+        self.agent_memory_size_data = pd.Series()
+        self.resident_agents_data = pd.Series()
+        self.agent_spill_data = pd.Series()
+        self.agent_reload_data = pd.Series()
         self.outgoing_bandwidth_data = defaultdict(pd.Series)
         self.incoming_bandwidth_data = defaultdict(pd.Series)
+        self.compressed_outgoing_bandwidth_data = defaultdict(pd.Series)
+        self.compressed_incoming_bandwidth_data = defaultdict(pd.Series)
+        self.compression_time_data = defaultdict(pd.Series)
+        self.decompression_time_data = defaultdict(pd.Series)
+        self.message_encode_time_data = defaultdict(pd.Series)
+        self.message_decode_time_data = defaultdict(pd.Series)
         self.social_evidence_diversity_data = defaultdict(pd.Series)
         self.unique_evidence_data = defaultdict(pd.Series)
 
@@ -79,7 +174,7 @@ def get_encryption_status(global_state, sender_email, recipient_emails):
             return EncStatus.plaintext
 
         view_enc_key = view.payload.metadata.identity_info
-        true_enc_key = global_state.agents[recipient_email].state.identity_info
+        true_enc_key = global_state.agents[recipient_email].current_enc_key
 
         if view_enc_key is None:
             return EncStatus.plaintext
@@ -134,6 +229,68 @@ def get_link_status(global_state, sender_email, recipient_emails):
     return link_status_summary, link_statuses
 
 
+def get_packed_message_size(message_metadata):
+    """Compute the size of the packed message metadata."""
+    return 1 + len(packb(message_metadata.head)) \
+             + len(packb(list(message_metadata.public_contacts))) \
+             + get_packed_store_size(message_metadata.store)
+
+
+def transmit_payload(codec, sender_email, recipient_emails, payload,
+                     receiving_emails):
+    """Compress a payload, and decompress it on the recipients' side.
+
+    Without shared dictionaries, the payload is compressed once for all
+    recipients. Otherwise, every recipient gets a separately compressed
+    payload. Like the uncompressed outgoing size, the outgoing size is
+    the size of one copy of the payload, averaged over the recipients
+    with shared dictionaries.
+
+    :param codec: :py:class:`PayloadCodec` to use
+    :param recipient_emails: All recipients of the payload
+    :param payload: Packed message
+    :param receiving_emails: Recipients that are simulated, and decompress
+                             the payload
+    :returns: Outgoing size of the compressed payload, compressed sizes
+              by recipient, CPU time of compression, and CPU times of
+              decompression by recipient
+    """
+    if codec.shared_dictionaries:
+        links = recipient_emails
+    else:
+        links = [None]
+
+    compressed_payloads = {}
+    compression_time = 0.0
+    for recipient_email in links:
+        dictionary = codec.get_dictionary(sender_email, recipient_email)
+        start = time.process_time()
+        compressed_payloads[recipient_email] = codec.compress(
+                payload, dictionary)
+        compression_time += time.process_time() - start
+
+    decompression_times = {}
+    for recipient_email in receiving_emails:
+        link = recipient_email if codec.shared_dictionaries else None
+        dictionary = codec.get_dictionary(sender_email, recipient_email)
+        start = time.process_time()
+        codec.decompress(compressed_payloads[link], dictionary)
+        decompression_times[recipient_email] = time.process_time() - start
+
+    compressed_sizes = {}
+    for recipient_email in recipient_emails:
+        link = recipient_email if codec.shared_dictionaries else None
+        compressed_sizes[recipient_email] = len(compressed_payloads[link])
+        codec.update_dictionary(sender_email, recipient_email, payload)
+
+    outgoing_size = sum(len(compressed_payload)
+                        for compressed_payload
+                        in compressed_payloads.values()) \
+                    / len(compressed_payloads)
+    return (outgoing_size, compressed_sizes, compression_time,
+            decompression_times)
+
+
 def do_simulation_step(index, email, global_state, reports):
     """Simulate single email."""
 
@@ -158,21 +315,43 @@ def do_simulation_step(index, email, global_state, reports):
     reports.participants_type_data.loc[index] = participants_type
 
     # Record bandwidth and cache size
-    packed_message_metadata = packb([
-            message_metadata.head,
-            list(message_metadata.public_contacts),
-            serialize_store(message_metadata.store)])
-    reports.outgoing_bandwidth_data[email.From].loc[index] = \
-           len(packed_message_metadata)
+    if global_state.wire_messages:
+        start = time.process_time()
+        payload = encode_message(message_metadata)
+        reports.message_encode_time_data[email.From].loc[index] = \
+                time.process_time() - start
+        message_size = len(payload)
+    else:
+        message_size = get_packed_message_size(message_metadata)
+    reports.outgoing_bandwidth_data[email.From].loc[index] = message_size
+    relevant_recipients = recipient_emails.intersection(
+            global_state.context.senders)
+    codec = global_state.payload_codec
+    if codec is not None:
+        if not global_state.wire_messages:
+            payload = pack_message(message_metadata)
+        (compressed_message_size, compressed_sizes, compression_time,
+         decompression_times) = transmit_payload(
+                codec, email.From, recipient_emails, payload,
+                relevant_recipients)
+        reports.compressed_outgoing_bandwidth_data[email.From].loc[index] = \
+                compressed_message_size
+        reports.compression_time_data[email.From].loc[index] = \
+                compression_time
     packed_sender_cache = packb(serialize_caches(
             sender.sent_object_keys_to_recipients))
     reports.cache_size_data[email.From].loc[index] = \
            len(packed_sender_cache)
 
+    # Record commits, and updates held back by the chain update policy
+    reports.chain_commits_data[email.From].loc[index] = sender.nb_commits
+    reports.queued_updates_data[email.From].loc[index] = \
+            sender.nb_queued_updates
+    reports.nonce_reuse_data[email.From].loc[index] = \
+            sender.nb_nonce_reuses
+
 
     # Record social evidence diversity
-    relevant_recipients = recipient_emails.intersection(
-            global_state.context.senders)
     unique_evidence_sizes = []
     diversity_values = []
 
@@ -191,52 +370,239 @@ def do_simulation_step(index, email, global_state, reports):
     # Update states of recipients
     for recipient_email in relevant_recipients:
         recipient = global_state.agents[recipient_email]
-        recipient.receive_message(email.From, message_metadata,
+        received_metadata = message_metadata
+        if global_state.wire_messages:
+            start = time.process_time()
+            received_metadata = decode_message(payload)
+            reports.message_decode_time_data[recipient_email].loc[index] = \
+                    time.process_time() - start
+        recipient.receive_message(email.From, received_metadata,
                 recipient_emails - {recipient_email})
 
         # Record receiver store sizes
-        packed_recipient_local_store = \
-                packb([serialize_store(recipient.chain_store),
-                       serialize_store(recipient.tree_store)])
         reports.local_store_size_data[recipient_email].loc[index] = \
-                len(packed_recipient_local_store)
-
-        packed_recipient_gossip_store = \
-                packb(serialize_store(recipient.gossip_store))
+                1 + get_packed_store_size(recipient.chain_store) \
+                  + get_packed_store_size(recipient.tree_store)
         reports.gossip_store_size_data[recipient_email].loc[index] = \
-                len(packed_recipient_gossip_store)
+                get_packed_store_size(recipient.gossip_store)
+        reports.gossip_eviction_data[recipient_email].loc[index] = \
+                recipient.nb_evicted_gossip_objects
+        reports.detected_forks_data[recipient_email].loc[index] = \
+                recipient.nb_detected_forks
 
         # Record incoming bandwidth
         reports.incoming_bandwidth_data[recipient_email].loc[index] = \
-                len(packed_message_metadata)
+                message_size
+        if codec is not None:
+            reports.compressed_incoming_bandwidth_data[recipient_email] \
+                    .loc[index] = compressed_sizes[recipient_email]
+            reports.decompression_time_data[recipient_email].loc[index] = \
+                    decompression_times[recipient_email]
+
+    # Record block cache efficiency
+    reports.block_encode_cache_hit_rate_data.loc[index] = \
+            encoded_block_cache.hit_rate
+    reports.block_decode_cache_hit_rate_data.loc[index] = \
+            decoded_block_cache.hit_rate
+    reports.view_cache_hit_rate_data.loc[index] = \
+            decoded_view_cache.hit_rate
+    reports.verification_cache_hit_rate_data.loc[index] = \
+            verified_object_cache.hit_rate
+    reports.object_pool_size_data.loc[index] = len(object_pool)
 
     global_state.recipients_by_sender[email.From] |= recipient_emails
+
+    # Record agent spills
+    global_state.trim_agents()
+    if isinstance(global_state.agents, SpillingAgentStore):
+        reports.resident_agents_data.loc[index] = \
+                global_state.agents.nb_resident
+        reports.agent_spill_data.loc[index] = global_state.agents.nb_spills
+        reports.agent_reload_data.loc[index] = global_state.agents.nb_reloads
+
     return global_state, reports
 
 
-def init_simulations(context):
+def record_agent_memory_sizes(global_state, reports):
+    """Record estimated memory taken by each agent in memory.
+
+    Spilled agents are skipped, rather than reloaded from disk.
+    """
+    shared_caches = [encoded_block_cache, decoded_block_cache,
+                     decoded_view_cache, verified_object_cache, object_pool]
+    if isinstance(global_state.agents, SpillingAgentStore):
+        resident_agents = global_state.agents.resident_items()
+    else:
+        resident_agents = global_state.agents.items()
+    for email, agent in resident_agents:
+        reports.agent_memory_size_data.loc[email] = get_deep_size(
+                agent, exclude=shared_caches)
+
+
+def warm_up(global_state, log, pbar=None):
+    """Approximate the state after a predecessor log, without simulating it.
+
+    Each distinct email, by its sender and recipients, is only sent once,
+    at the time of its last occurrence in the log, so agents learn about
+    the same people as after the full log, and their keys are close to
+    the ones after the full log. Nothing is reported.
+
+    :param global_state: ``GlobalState`` object to warm up
+    :param log: Predecessor log
+    """
+    if pbar is None:
+        pbar = tqdm
+
+    last_emails = {}
+    for email in log:
+        recipient_emails = (email.To | email.Cc | email.Bcc) - {email.From}
+        if recipient_emails:
+            last_emails[(email.From, frozenset(recipient_emails))] = email
+            global_state.add_agent(email.From)
+
+    for (sender_email, recipient_emails), email in pbar(
+            sorted(last_emails.items(), key=lambda item: item[1].mtime)):
+        sender = global_state.agents[sender_email]
+        message_metadata = sender.send_message(recipient_emails, email.mtime)
+        for recipient_email in recipient_emails:
+            if recipient_email in global_state.agents:
+                recipient = global_state.agents[recipient_email]
+                recipient.receive_message(sender_email, message_metadata,
+                        recipient_emails - {recipient_email})
+        global_state.recipients_by_sender[sender_email] |= recipient_emails
+        global_state.trim_agents()
+
+
+def init_simulations(context, max_resident_agents=None, spill_path=None,
+                     stub_outside_userset=False, payload_compression=None,
+                     shared_dictionaries=False, snapshot=None,
+                     wire_messages=False, record_memory_sizes=False):
     """Initialize simulation state and reports."""
-    global_state = GlobalState(context)
+    global_state = GlobalState(context, max_resident_agents, spill_path,
+                               stub_outside_userset, payload_compression,
+                               shared_dictionaries, snapshot, wire_messages,
+                               record_memory_sizes)
     reports = SimulationReports(context)
     return global_state, reports
 
 
-def simulate_claimchain(context, pbar=None):
+def simulate_claimchain(context, pbar=None, max_resident_agents=None,
+                        spill_path=None, stub_outside_userset=False,
+                        payload_compression=None, shared_dictionaries=False,
+                        snapshot=None, wire_messages=False,
+                        record_memory_sizes=False):
     """Run simulations."""
     logger.info('Simulating ClaimChain')
     logger.info('Common agent settings: %s', AgentSettings.get_default())
 
-    state, reports = init_simulations(context)
+    global_state, reports = init_simulations(
+            context, max_resident_agents, spill_path, stub_outside_userset,
+            payload_compression, shared_dictionaries, snapshot,
+            wire_messages, record_memory_sizes)
 
     if pbar is None:
         pbar = tqdm
 
-    for index, email in pbar(list(enumerate(context.log))):
-        global_state, reports = do_simulation_step(
-                index, email, state, reports)
-
-    logging.info('Emails: Sent: %d, Encrypted: %d',
-            global_state.sent_email_count,
-            global_state.encrypted_email_count)
+    try:
+        for index, email in pbar(list(enumerate(context.log))):
+            global_state, reports = do_simulation_step(
+                    index, email, global_state, reports)
+
+        logging.info('Emails: Sent: %d, Encrypted: %d',
+                global_state.sent_email_count,
+                global_state.encrypted_email_count)
+
+        if record_memory_sizes:
+            record_agent_memory_sizes(global_state, reports)
+            logging.info('Mean agent memory size: %d bytes',
+                    reports.agent_memory_size_data.mean())
+        if payload_compression is not None:
+            logging.info('Bandwidth: Uncompressed: %d, Compressed: %d bytes',
+                    _get_total(reports.outgoing_bandwidth_data),
+                    _get_total(reports.compressed_outgoing_bandwidth_data))
+        nb_nonce_reuses = _get_total(reports.nonce_reuse_data,
+                                     last_only=True)
+        if nb_nonce_reuses:
+            logging.warning('Protocol deviation: %d commits reused a nonce',
+                    nb_nonce_reuses)
+        if wire_messages:
+            logging.info('Message CPU time: Encoding: %.2f, Decoding: %.2f s',
+                    _get_total(reports.message_encode_time_data),
+                    _get_total(reports.message_decode_time_data))
+        if max_resident_agents is not None:
+            logging.info('Agents: Spilled: %d, Reloaded: %d',
+                    global_state.agents.nb_spills,
+                    global_state.agents.nb_reloads)
+    finally:
+        global_state.close()
 
     return reports
+
+
+def _get_total(data_by_user, last_only=False):
+    if last_only:
+        return sum(series.iloc[-1] for series in data_by_user.values()
+                   if len(series))
+    return sum(series.sum() for series in data_by_user.values())
+
+
+def compare_reports(reports, reference_reports):
+    """Compare reports of two simulations of the same log.
+
+    :returns: Number of emails with a different encryption status, and
+              relative differences of the total bandwidth, and of the
+              final store sizes
+    """
+    def relative_difference(value, reference_value):
+        if reference_value == 0:
+            return float(value != 0)
+        return float(abs(value - reference_value) / reference_value)
+
+    enc_status_mismatches = (reports.encryption_status_data !=
+            reference_reports.encryption_status_data).sum()
+    return {
+        'encryption_status_mismatches': int(enc_status_mismatches),
+        'outgoing_bandwidth': relative_difference(
+            _get_total(reports.outgoing_bandwidth_data),
+            _get_total(reference_reports.outgoing_bandwidth_data)),
+        'gossip_store_size': relative_difference(
+            _get_total(reports.gossip_store_size_data, last_only=True),
+            _get_total(reference_reports.gossip_store_size_data,
+                       last_only=True)),
+        'local_store_size': relative_difference(
+            _get_total(reports.local_store_size_data, last_only=True),
+            _get_total(reference_reports.local_store_size_data,
+                       last_only=True)),
+    }
+
+
+def validate_fast_backend(context, sample_size=1000, pbar=None,
+                          tolerance=0.01):
+    """Check reports of the fast backend against the real ClaimChain.
+
+    Simulates the beginning of the log with both backends, using the
+    current agent settings otherwise.
+
+    :param context: Simulation context
+    :param sample_size: Number of log entries to simulate
+    :param tolerance: Largest accepted relative difference of the sizes
+    :returns: Comparison of the reports, see :py:func:`compare_reports`
+    :raises ValueError: If any encryption status differs, or any size
+                        differs by more than the tolerance
+    """
+    sample_context = Context(context.log[:sample_size], context.social_graph)
+    settings = AgentSettings.get_default()
+    with AgentSettings.set_default(evolve(settings, fast_backend=False)):
+        reference_reports = simulate_claimchain(sample_context, pbar)
+    with AgentSettings.set_default(evolve(settings, fast_backend=True)):
+        reports = simulate_claimchain(sample_context, pbar)
+
+    comparison = compare_reports(reports, reference_reports)
+    logger.info('Fast backend validation: %s', comparison)
+    size_differences = [difference for name, difference in comparison.items()
+                        if name != 'encryption_status_mismatches']
+    if comparison['encryption_status_mismatches'] > 0 or \
+            max(size_differences) > tolerance:
+        raise ValueError('The fast backend does not match the real '
+                         'ClaimChain: %s' % comparison)
+    return comparison
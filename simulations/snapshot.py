@@ -0,0 +1,71 @@
+"""
+Snapshots of simulation states, to warm-start later chunks of the log
+"""
+
+import pickle
+
+from .spill import _AgentPickler, _AgentUnpickler
+
+
+class _SnapshotPickler(_AgentPickler):
+    """Pickler of one agent that leaves out its cached claim lookups.
+
+    The lookups are saved as the shared empty container, without changing
+    the agent, since later chunks can recompute them.
+    """
+    def __init__(self, file, agent, protocol=None):
+        super(_SnapshotPickler, self).__init__(file, protocol=protocol)
+        self._claim_lookups = agent.claim_lookups
+
+    def persistent_id(self, obj):
+        if obj is self._claim_lookups:
+            return ('empty_dict',)
+        return super(_SnapshotPickler, self).persistent_id(obj)
+
+
+def save_snapshot(global_state, path):
+    """Save the agents of a simulation state, and whom they sent emails to.
+
+    Agents are saved one at a time, and are not modified. Spilled agents
+    are reloaded one at a time, and spilled again before the next one.
+
+    :param global_state: ``GlobalState`` object
+    :param path: Path to the snapshot file
+    """
+    emails = list(global_state.agents)
+    header = {
+        'emails': emails,
+        'recipients_by_sender': dict(global_state.recipients_by_sender),
+    }
+    with open(path, 'wb') as h:
+        pickle.dump(header, h, protocol=pickle.HIGHEST_PROTOCOL)
+        for email in emails:
+            agent = global_state.agents[email]
+            _SnapshotPickler(h, agent, protocol=pickle.HIGHEST_PROTOCOL) \
+                    .dump(agent)
+            global_state.trim_agents()
+
+
+def _load_agents(path, offset, emails):
+    with open(path, 'rb') as h:
+        h.seek(offset)
+        for email in emails:
+            yield email, _AgentUnpickler(h).load()
+
+
+def load_snapshot(path):
+    """Load a snapshot saved with :py:func:`save_snapshot`.
+
+    Agents are unpickled one at a time, as they are iterated over, so
+    that the loaded state can spill them before the next one.
+
+    :returns: Dictionary with an iterator over the pairs of emails and
+              agents, and the sets of recipients by sender
+    """
+    with open(path, 'rb') as h:
+        header = pickle.load(h)
+        offset = h.tell()
+    return {
+        'agents': _load_agents(path, offset, header['emails']),
+        'recipients_by_sender': header['recipients_by_sender'],
+    }
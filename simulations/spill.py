@@ -0,0 +1,154 @@
+"""
+Agents mapping that keeps a bounded set of agents in memory
+"""
+
+import io
+import os
+import pickle
+import sqlite3
+import tempfile
+
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+from petlib.bn import Bn
+from petlib.ec import EcGroup, EcPt
+
+from .utils import EMPTY_DICT, EMPTY_SET
+
+
+class _AgentPickler(pickle.Pickler):
+    """Pickler for objects that the standard pickle can not handle.
+
+    Petlib objects are stored in their exported forms, process pools by
+    their number of workers, and the shared empty containers by reference,
+    so that they stay shared after reloading.
+    """
+    def persistent_id(self, obj):
+        if obj is EMPTY_DICT:
+            return ('empty_dict',)
+        if obj is EMPTY_SET:
+            return ('empty_set',)
+        if isinstance(obj, Bn):
+            return ('bn', obj.repr())
+        if isinstance(obj, EcGroup):
+            return ('ec_group', obj.nid())
+        if isinstance(obj, EcPt):
+            return ('ec_pt', obj.group.nid(), obj.export())
+        return None
+
+
+class _AgentUnpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        kind = pid[0]
+        if kind == 'empty_dict':
+            return EMPTY_DICT
+        if kind == 'empty_set':
+            return EMPTY_SET
+        if kind == 'bn':
+            return Bn.from_decimal(pid[1])
+        if kind == 'ec_group':
+            return EcGroup(pid[1])
+        if kind == 'ec_pt':
+            return EcPt.from_binary(pid[2], EcGroup(pid[1]))
+        raise pickle.UnpicklingError('Unknown persistent id: %s' % kind)
+
+
+def dump_agent(agent):
+    """Serialize an agent with all its stores."""
+    buf = io.BytesIO()
+    _AgentPickler(buf, protocol=pickle.HIGHEST_PROTOCOL).dump(agent)
+    return buf.getvalue()
+
+
+def load_agent(data):
+    """Deserialize an agent serialized with :py:func:`dump_agent`."""
+    return _AgentUnpickler(io.BytesIO(data)).load()
+
+
+class SpillingAgentStore(MutableMapping):
+    """Agents by email, with only the recently used ones kept in memory.
+
+    Agents are spilled to an sqlite database when :py:meth:`trim` is
+    called, least recently used first, and reloaded when accessed. Agents
+    are never spilled on access, so the agents that are in use can be
+    safely modified until the next :py:meth:`trim`.
+
+    :param max_resident: Number of agents to keep in memory
+    :param path: Path to the database, or None to use a temporary file,
+                 which is deleted on :py:meth:`close`
+    """
+
+    def __init__(self, max_resident, path=None):
+        self.max_resident = max_resident
+        self._is_temporary = path is None
+        if path is None:
+            handle, path = tempfile.mkstemp(suffix='.sqlite')
+            os.close(handle)
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS agents '
+                         '(email TEXT PRIMARY KEY, data BLOB)')
+        self._emails = set()
+        self._resident = OrderedDict()
+
+        # Stats
+        self.nb_spills = 0
+        self.nb_reloads = 0
+
+    @property
+    def nb_resident(self):
+        return len(self._resident)
+
+    def __getitem__(self, email):
+        agent = self._resident.get(email)
+        if agent is not None:
+            self._resident.move_to_end(email)
+            return agent
+        if email not in self._emails:
+            raise KeyError(email)
+
+        row = self._db.execute('SELECT data FROM agents WHERE email = ?',
+                               (email,)).fetchone()
+        agent = load_agent(row[0])
+        self.nb_reloads += 1
+        self._resident[email] = agent
+        return agent
+
+    def __setitem__(self, email, agent):
+        self._emails.add(email)
+        self._resident[email] = agent
+        self._resident.move_to_end(email)
+
+    def __delitem__(self, email):
+        self._emails.remove(email)
+        self._resident.pop(email, None)
+        self._db.execute('DELETE FROM agents WHERE email = ?', (email,))
+
+    def __contains__(self, email):
+        return email in self._emails
+
+    def __iter__(self):
+        return iter(list(self._emails))
+
+    def __len__(self):
+        return len(self._emails)
+
+    def resident_items(self):
+        """Pairs of emails and agents that are in memory."""
+        return list(self._resident.items())
+
+    def trim(self):
+        """Spill the least recently used agents that do not fit in memory."""
+        while len(self._resident) > self.max_resident:
+            email, agent = self._resident.popitem(last=False)
+            self._db.execute('INSERT OR REPLACE INTO agents VALUES (?, ?)',
+                             (email, dump_agent(agent)))
+            self.nb_spills += 1
+        self._db.commit()
+
+    def close(self):
+        """Close the database, and delete it if it is temporary."""
+        self._db.close()
+        if self._is_temporary and os.path.exists(self.path):
+            os.remove(self.path)
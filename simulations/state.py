@@ -0,0 +1,316 @@
+"""
+ClaimChain owner states with batched and cached encoding of entries.
+"""
+
+import os
+import warnings
+
+from hashlib import sha256
+
+from petlib.pack import encode
+from claimchain import State, LocalParams
+from claimchain.core import encode_claim, _compute_capability_key, \
+                           _compute_claim_key, _fix_bytes
+from claimchain.crypto import PublicParams
+from claimchain.state import Payload, _build_tree, _sign_block
+from claimchain.utils import ensure_binary
+
+
+def encode_capability_with_secret(shared_secret, nonce, claim_label,
+                                  vrf_value):
+    """Encode capability with a precomputed DH shared secret.
+
+    Same as ``claimchain.core.encode_capability``, but takes the shared
+    secret of the owner and the reader instead of the reader's DH key.
+    """
+    claim_label = ensure_binary(claim_label)
+    pp = PublicParams.get_default()
+    lookup_key = _compute_capability_key(
+            nonce, shared_secret, claim_label, mode='lookup')
+    enc_key = _compute_capability_key(
+            nonce, shared_secret, claim_label, mode='enc')
+
+    enc_body, tag = pp.enc_cipher.quick_gcm_enc(
+            enc_key, b"\x00"*pp.enc_key_size, vrf_value)
+    tag = _fix_bytes(tag)
+
+    return lookup_key, encode([enc_body, tag])
+
+
+class BatchState(State):
+    """ClaimChain owner state that encodes capabilities in batches.
+
+    Capability entries are listed by reader, and encoded with the DH
+    shared secret of each reader. Capability encoding is deterministic,
+    so the entries are the same as the ones :py:class:`claimchain.State`
+    would encode. DH shared secrets with the readers are computed once,
+    and reused until :py:meth:`clear_shared_secrets` is called.
+
+    :param identity_info: Owner's identity info (public key)
+    """
+
+    def __init__(self, identity_info=None):
+        super(BatchState, self).__init__(identity_info)
+        self._shared_secrets = {}
+
+        # Stats
+        self.nb_shared_secret_computations = 0
+        self.nb_nonce_reuses = 0
+
+    def get_shared_secret(self, reader_dh_pk):
+        """Get the DH shared secret of the owner and a reader.
+
+        Shared secrets are cached by the owner's and the reader's DH keys.
+
+        :param petlib.EcPt reader_dh_pk: Reader's DH public key
+        """
+        params = LocalParams.get_default()
+        cache_key = (params.dh.pk, reader_dh_pk)
+        shared_secret = self._shared_secrets.get(cache_key)
+        if shared_secret is None:
+            shared_secret = params.dh.sk * reader_dh_pk
+            self._shared_secrets[cache_key] = shared_secret
+            self.nb_shared_secret_computations += 1
+        return shared_secret
+
+    def clear_shared_secrets(self, reader_dh_pk=None):
+        """Drop cached shared secrets.
+
+        :param reader_dh_pk: Reader's DH public key, or None to drop the
+                             shared secrets of all readers
+        """
+        if reader_dh_pk is None:
+            self._shared_secrets.clear()
+            return
+        for cache_key in list(self._shared_secrets):
+            if cache_key[1] == reader_dh_pk:
+                del self._shared_secrets[cache_key]
+
+    def _get_capability_lookup_key(self, reader_dh_pk, claim_label):
+        return _compute_capability_key(
+                self._nonce, self.get_shared_secret(reader_dh_pk),
+                claim_label, mode='lookup')
+
+    def _get_nonce(self, nonce=None):
+        return nonce or os.urandom(PublicParams.get_default().nonce_size)
+
+    def _encode_claims(self, nonce):
+        """Encode claims.
+
+        :returns: Pairs of claim labels and encoded claims
+        """
+        return [(claim_label, encode_claim(nonce, claim_label, claim_content))
+                for claim_label, claim_content
+                in self._claim_content_by_label.items()]
+
+    def _list_capabilities(self, vrf_value_by_label):
+        """List the capability entries to encode for each reader.
+
+        :returns: Pairs of reader DH keys and lists of claim labels with
+                  their VRF values
+        """
+        batches = []
+        for reader_dh_pk, caps in self._caps_by_reader_pk.items():
+            batch = []
+            for claim_label in caps:
+                try:
+                    vrf_value = vrf_value_by_label[claim_label]
+                except KeyError:
+                    warnings.warn("VRF for %s not computed. "
+                                  "Skipping adding a capability." \
+                                  % claim_label)
+                    break
+                batch.append((claim_label, vrf_value))
+            batches.append((reader_dh_pk, batch))
+        return batches
+
+    def _encode_capabilities(self, nonce, batches):
+        """Encode capabilities.
+
+        :param batches: Entries to encode, as listed by
+                        :py:meth:`_list_capabilities`
+        :returns: Pairs of capability lookup keys and encoded capabilities,
+                  in the order of the entries
+        """
+        return [encode_capability_with_secret(
+                    self.get_shared_secret(reader_dh_pk),
+                    nonce, claim_label, vrf_value)
+                for reader_dh_pk, batch in batches
+                for claim_label, vrf_value in batch]
+
+    def _sign_block(self, block):
+        _sign_block(block)
+
+    def commit(self, target_chain, tree_store=None, nonce=None):
+        """Commit state to a chain.
+
+        Constructs a new block and appends to a chain.
+
+        :param hippiehug.Chain target_chain: Chain to which a block will be
+                appended.
+        :param utils.ObjectStore tree_store: Object store to hold tree nodes.
+        :param bytes nonce: Nonce to include in the new block.
+        """
+        if tree_store is None:
+            tree_store = target_chain.store
+        self._nonce = nonce = self._get_nonce(nonce)
+
+        # Encode claims
+        enc_items_map = {}
+        vrf_value_by_label = {}
+        for claim_label, encoded in self._encode_claims(nonce):
+            vrf_value, lookup_key, enc_claim = encoded
+            enc_items_map[lookup_key] = enc_claim
+            vrf_value_by_label[claim_label] = vrf_value
+
+        # Encode capabilities
+        batches = self._list_capabilities(vrf_value_by_label)
+        for lookup_key, enc_cap in self._encode_capabilities(nonce, batches):
+            enc_items_map[lookup_key] = enc_cap
+
+        # Put all the encrypted items in a new tree
+        tree = _build_tree(tree_store, enc_items_map)
+
+        # Construct payload
+        payload = Payload.build(
+                tree=tree,
+                identity_info=self.identity_info,
+                nonce=nonce)
+        target_chain.multi_add([payload.export()],
+                               pre_commit_fn=self._sign_block)
+
+        self._payload = payload
+        self._tree = tree
+        self._enc_items_map = enc_items_map
+        self._vrf_value_by_label = vrf_value_by_label
+
+        return target_chain.head
+
+    def compute_evidence_keys(self, reader_dh_pk, claim_label):
+        """List hashes of all nodes that prove inclusion of a claim label.
+
+        :param petlib.EcPt reader_dh_pk: Reader's DH public key
+        :param bytes claim_label: Claim label
+        """
+        try:
+            vrf_value = self._vrf_value_by_label[claim_label]
+            cap_lookup_key = self._get_capability_lookup_key(
+                    reader_dh_pk, claim_label)
+
+            # Compute capability entry evidence
+            _, raw_cap_evidence = self.tree.evidence(cap_lookup_key)
+            claim_lookup_key = _compute_claim_key(vrf_value, mode='lookup')
+
+            # Compute claim evidence
+            _, raw_claim_evidence = self.tree.evidence(claim_lookup_key)
+            object_keys = {obj.hid for obj in raw_cap_evidence} | \
+                          {obj.hid for obj in raw_claim_evidence}
+
+            # Add encoded capability and encoded claim value
+            encoded_cap_hash = raw_cap_evidence[-1].item
+            encoded_claim_hash = raw_claim_evidence[-1].item
+            return object_keys | {encoded_claim_hash} | {encoded_cap_hash}
+        except KeyError:
+            return set()
+
+
+class CachingState(BatchState):
+    """ClaimChain owner state that reuses encodings across commits.
+
+    Encoded claims and capabilities depend on the block nonce. This state
+    keeps the same nonce for all commits until :py:meth:`clear_cache` is
+    called, so that claims and capability entries that have not changed
+    since the previous commit are not encoded again.
+
+    .. warning ::
+        This is a protocol deviation. ClaimChain uses a fresh nonce for
+        every block, so that entries of different blocks can not be
+        linked. Here, lookup keys of unchanged claims and capabilities are
+        the same in all blocks of an epoch, and observers can link them.
+        Commits that reuse a nonce are counted in ``nb_nonce_reuses``.
+
+    .. note ::
+        Blocks committed with the same nonce share the tree nodes of the
+        unchanged entries, so fewer new objects are created per commit
+        than with :py:class:`claimchain.State`.
+
+    :param identity_info: Owner's identity info (public key)
+    """
+
+    def __init__(self, identity_info=None):
+        super(CachingState, self).__init__(identity_info)
+        self._epoch_nonce = None
+        self._enc_claim_cache = {}
+        self._enc_cap_cache = {}
+
+        # Stats
+        self.nb_cache_hits = 0
+        self.nb_cache_misses = 0
+
+    def clear_cache(self):
+        """Drop cached encodings, and use a new nonce for later commits."""
+        self._epoch_nonce = None
+        self._enc_claim_cache.clear()
+        self._enc_cap_cache.clear()
+
+    def _get_nonce(self, nonce=None):
+        if nonce is not None and nonce != self._epoch_nonce:
+            self.clear_cache()
+            self._epoch_nonce = nonce
+        if self._epoch_nonce is None:
+            self._epoch_nonce = super(CachingState, self)._get_nonce()
+        elif nonce is None:
+            self.nb_nonce_reuses += 1
+        return self._epoch_nonce
+
+    def _encode_claims(self, nonce):
+        # Only the entries used in this commit are kept in the cache.
+        enc_claim_cache = {}
+        encoded_claims = []
+        for claim_label, claim_content in self._claim_content_by_label.items():
+            cache_key = (claim_label,
+                         sha256(ensure_binary(claim_content)).digest())
+            encoded = self._enc_claim_cache.get(cache_key)
+            if encoded is None:
+                self.nb_cache_misses += 1
+                encoded = encode_claim(nonce, claim_label, claim_content)
+            else:
+                self.nb_cache_hits += 1
+            enc_claim_cache[cache_key] = encoded
+            encoded_claims.append((claim_label, encoded))
+
+        self._enc_claim_cache = enc_claim_cache
+        return encoded_claims
+
+    def _encode_capabilities(self, nonce, batches):
+        # Encode the entries that are not in the cache in a batch.
+        cache_keys = []
+        missing_batches = []
+        for reader_dh_pk, batch in batches:
+            exported_reader_dh_pk = reader_dh_pk.export()
+            missing_batch = []
+            for claim_label, vrf_value in batch:
+                cache_key = (exported_reader_dh_pk, claim_label, vrf_value)
+                cache_keys.append(cache_key)
+                if cache_key not in self._enc_cap_cache:
+                    missing_batch.append((claim_label, vrf_value))
+            missing_batches.append((reader_dh_pk, missing_batch))
+
+        new_entries = iter(super(CachingState, self)._encode_capabilities(
+                nonce, missing_batches))
+
+        # Only the entries used in this commit are kept in the cache.
+        enc_cap_cache = {}
+        encoded_caps = []
+        for cache_key in cache_keys:
+            encoded = self._enc_cap_cache.get(cache_key)
+            if encoded is None:
+                self.nb_cache_misses += 1
+                encoded = next(new_entries)
+            else:
+                self.nb_cache_hits += 1
+            enc_cap_cache[cache_key] = encoded
+            encoded_caps.append(encoded)
+
+        self._enc_cap_cache = enc_cap_cache
+        return encoded_caps
@@ -2,12 +2,67 @@
 Misc. utility functions and classes for simulations
 """
 
+import sys
+import zlib
+import weakref
+
 from enum import Enum
+from types import FunctionType, MappingProxyType, ModuleType
+from collections import ChainMap, OrderedDict
+from collections.abc import MutableMapping
 
 from attr import attrs, attrib
+from msgpack import packb
 
 from defaultcontext import with_default_context
-from claimchain.utils.wrappers import serialize_object
+from claimchain.utils.wrappers import ObjectStore, serialize_object
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Shared read-only empty containers.
+EMPTY_DICT = MappingProxyType({})
+EMPTY_SET = frozenset()
+
+
+def get_deep_size(obj, exclude=()):
+    """Estimate the memory taken by an object and everything it refers to.
+
+    Objects referenced multiple times are only counted once. Classes,
+    modules, functions, and the shared empty containers are not counted.
+
+    :param obj: Object to measure
+    :param exclude: Other objects to not count, e.g., shared caches
+    :returns: Size in bytes
+    """
+    seen = {id(EMPTY_DICT), id(EMPTY_SET)}
+    seen.update(id(excluded) for excluded in exclude)
+    size = 0
+    objs_to_visit = [obj]
+    while objs_to_visit:
+        current = objs_to_visit.pop()
+        if id(current) in seen or \
+                isinstance(current, (type, ModuleType, FunctionType)):
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+
+        if isinstance(current, (str, bytes, bytearray, int, float)):
+            continue
+        if isinstance(current, dict):
+            objs_to_visit.extend(current.keys())
+            objs_to_visit.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            objs_to_visit.extend(current)
+        if hasattr(current, '__dict__'):
+            objs_to_visit.append(current.__dict__)
+        for slot in getattr(type(current), '__slots__', ()):
+            if hasattr(current, slot):
+                objs_to_visit.append(getattr(current, slot))
+    return size
 
 
 class EncStatus(Enum):
@@ -22,12 +77,335 @@ class LinkStatus(Enum):
     completed = 2
 
 
+def check_hash(lookup_key, obj):
+    """Check that the object is stored under its hash.
+
+    Objects are immutable, so each object is only hashed once for a key.
+    Later checks of the same object are cache hits.
+    """
+    if verified_object_cache.get(lookup_key) is obj:
+        return
+    if obj.hid != lookup_key:
+        raise ValueError('Hash of the value is not the lookup key')
+    verified_object_cache[lookup_key] = obj
+
+
+class VerifiedObjectStore(ObjectStore):
+    """Object store that does not re-hash already verified objects."""
+    def __getitem__(self, lookup_key):
+        obj = self._backend[lookup_key]
+        check_hash(lookup_key, obj)
+        return obj
+
+    def __setitem__(self, lookup_key, obj):
+        check_hash(lookup_key, obj)
+        self._backend[lookup_key] = obj
+
+
+class OverlayStore(VerifiedObjectStore):
+    """Object store layered over other stores without copying them.
+
+    Lookups are resolved against the layers in the given order. Writes go
+    to a private top layer, so the underlying stores are never modified.
+
+    :param layers: ``ObjectStore`` objects or plain dictionaries, from the
+                   highest priority to the lowest
+    """
+    def __init__(self, *layers):
+        backends = [layer._backend if isinstance(layer, ObjectStore)
+                    else layer for layer in layers]
+        self._backend = ChainMap({}, *backends)
+
+
+class EvictableObjectStore(VerifiedObjectStore):
+    """Object store that supports removing objects."""
+    def __len__(self):
+        return len(self._backend)
+
+    def __contains__(self, lookup_key):
+        return lookup_key in self._backend
+
+    def __delitem__(self, lookup_key):
+        del self._backend[lookup_key]
+
+
+class ObjectPool(object):
+    """Content-addressed objects shared by many stores.
+
+    Each object is kept once, with the number of stores that hold it, and
+    dropped when no store holds it anymore.
+    """
+    def __init__(self):
+        self._objects = {}
+        self._refcounts = {}
+
+    def acquire(self, lookup_key, obj):
+        """Add a reference to an object.
+
+        :returns: The pooled object with the same key
+        """
+        if lookup_key in self._objects:
+            self._refcounts[lookup_key] += 1
+            return self._objects[lookup_key]
+        self._objects[lookup_key] = obj
+        self._refcounts[lookup_key] = 1
+        return obj
+
+    def release(self, lookup_key):
+        """Remove a reference to an object."""
+        refcount = self._refcounts[lookup_key] - 1
+        if refcount:
+            self._refcounts[lookup_key] = refcount
+        else:
+            del self._objects[lookup_key]
+            del self._refcounts[lookup_key]
+
+    def release_all(self, lookup_keys):
+        for lookup_key in lookup_keys:
+            self.release(lookup_key)
+
+    def __getitem__(self, lookup_key):
+        return self._objects[lookup_key]
+
+    def __len__(self):
+        return len(self._objects)
+
+
+# Pool shared by all agents' gossip stores.
+object_pool = ObjectPool()
+
+
+def _load_pooled_backend(items):
+    backend = _PooledBackend(object_pool)
+    backend.update(items)
+    return backend
+
+
+class _PooledBackend(MutableMapping):
+    """Set of keys of objects that are kept in an object pool."""
+    def __init__(self, pool):
+        self.pool = pool
+        self._keys = set()
+        # Release the references when the backend is garbage collected.
+        weakref.finalize(self, pool.release_all, self._keys)
+
+    def __getitem__(self, lookup_key):
+        if lookup_key not in self._keys:
+            raise KeyError(lookup_key)
+        return self.pool[lookup_key]
+
+    def __setitem__(self, lookup_key, obj):
+        if lookup_key not in self._keys:
+            self.pool.acquire(lookup_key, obj)
+            self._keys.add(lookup_key)
+
+    def __delitem__(self, lookup_key):
+        self._keys.remove(lookup_key)
+        self.pool.release(lookup_key)
+
+    def __contains__(self, lookup_key):
+        return lookup_key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __reduce__(self):
+        # Pickled with the objects, and loaded into the shared pool.
+        return _load_pooled_backend, (dict(self.items()),)
+
+
+class PooledObjectStore(EvictableObjectStore):
+    """Object store that only holds keys of objects in an object pool.
+
+    Stores with the same objects share a single copy of each object. The
+    keys, values, and items of the store are the same as if the objects
+    were stored in it directly.
+
+    :param pool: ``ObjectPool``, or None to use the shared pool
+    """
+    def __init__(self, pool=None):
+        if pool is None:
+            pool = object_pool
+        self._backend = _PooledBackend(pool)
+
+
+class LRUCache(object):
+    """Bounded mapping that evicts the least recently used entries.
+
+    :param int maxsize: Maximum number of entries
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+        # Stats
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Get an entry, and mark it as the most recently used."""
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        """Ratio of lookups that were found in the cache."""
+        nb_lookups = self.hits + self.misses
+        if nb_lookups == 0:
+            return 0.0
+        return self.hits / nb_lookups
+
+    def clear(self):
+        """Remove all entries, and reset the stats."""
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# Objects that hash to their lookup keys, by the keys. Shared by all
+# agents, since the objects are shared too.
+verified_object_cache = LRUCache(2 ** 18)
+
+
 def serialize_store(store):
     keys = list(store.keys())
     values = [serialize_object(obj) for obj in store.values()]
     return (keys, values)
 
 
+# Packed sizes of keys and serialized objects, by the object keys.
+packed_object_size_cache = LRUCache(2 ** 18)
+
+
+def get_packed_array_header_size(length):
+    """Size of a msgpack array header."""
+    if length < 16:
+        return 1
+    elif length < 2 ** 16:
+        return 3
+    else:
+        return 5
+
+
+def get_packed_store_size(store):
+    """Compute ``len(packb(serialize_store(store)))`` without packing.
+
+    Objects are immutable and addressed by their keys, so the packed size
+    of every object is only computed once.
+    """
+    nb_objects = 0
+    objects_size = 0
+    for lookup_key, obj in store.items():
+        object_size = packed_object_size_cache.get(lookup_key)
+        if object_size is None:
+            object_size = len(packb(lookup_key)) \
+                        + len(packb(serialize_object(obj)))
+            packed_object_size_cache[lookup_key] = object_size
+        nb_objects += 1
+        objects_size += object_size
+
+    # Pair of the key and value arrays.
+    return 1 + 2 * get_packed_array_header_size(nb_objects) + objects_size
+
+
+def pack_message(message_metadata):
+    """Pack the message metadata as it would be sent."""
+    return packb([message_metadata.head,
+                  list(message_metadata.public_contacts),
+                  serialize_store(message_metadata.store)])
+
+
+class PayloadCodec(object):
+    """Compressor of message payloads.
+
+    With shared dictionaries, payloads are compressed against the recent
+    payloads between the same sender and recipient, which both sides
+    have seen.
+
+    :param method: ``zlib``, ``zstd``, or ``auto`` to use zstd if available
+    :param shared_dictionaries: Whether to use per-pair dictionaries
+    """
+
+    # Max zlib window size.
+    DICTIONARY_SIZE = 32 * 1024
+
+    def __init__(self, method='auto', shared_dictionaries=False):
+        if method == 'auto':
+            method = 'zlib' if zstandard is None else 'zstd'
+        if method == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression requires zstandard.')
+        if method not in ('zlib', 'zstd'):
+            raise ValueError('Unknown compression method: %s' % method)
+        self.method = method
+        self.shared_dictionaries = shared_dictionaries
+        self._dictionaries = {}
+
+    def get_dictionary(self, sender, recipient):
+        """Get the dictionary shared by the sender and the recipient."""
+        if not self.shared_dictionaries:
+            return b''
+        return self._dictionaries.get((sender, recipient), b'')
+
+    def update_dictionary(self, sender, recipient, payload):
+        """Add a payload to the dictionary shared by the pair."""
+        if not self.shared_dictionaries:
+            return
+        dictionary = self.get_dictionary(sender, recipient) + payload
+        self._dictionaries[(sender, recipient)] = \
+                dictionary[-self.DICTIONARY_SIZE:]
+
+    def compress(self, payload, dictionary=b''):
+        if self.method == 'zstd':
+            dict_data = None
+            if dictionary:
+                dict_data = zstandard.ZstdCompressionDict(
+                        dictionary, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+            return zstandard.ZstdCompressor(dict_data=dict_data).compress(
+                    payload)
+
+        if dictionary:
+            compressor = zlib.compressobj(zdict=dictionary)
+        else:
+            compressor = zlib.compressobj()
+        return compressor.compress(payload) + compressor.flush()
+
+    def decompress(self, data, dictionary=b''):
+        if self.method == 'zstd':
+            dict_data = None
+            if dictionary:
+                dict_data = zstandard.ZstdCompressionDict(
+                        dictionary, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+            return zstandard.ZstdDecompressor(dict_data=dict_data) \
+                    .decompress(data)
+
+        if dictionary:
+            decompressor = zlib.decompressobj(zdict=dictionary)
+        else:
+            decompressor = zlib.decompressobj()
+        return decompressor.decompress(data) + decompressor.flush()
+
+
 def serialize_caches(caches):
     return list(caches)
 
@@ -3,8 +3,10 @@ import pytest
 
 from hippiehug import Chain
 from claimchain import View, State, LocalParams
+from claimchain.utils import ascii2bytes
 
 from simulations.agent import *
+from simulations.utils import get_deep_size
 
 
 @pytest.fixture
@@ -174,3 +176,521 @@ def test_agent_public_contacts_policy():
         assert carol.committed_caps[PUBLIC_READER_LABEL] == {'bob', 'alice'}
 
 
+def test_agent_receive_keeps_message_objects():
+    alice = Agent('alice')
+    bob = Agent('bob')
+
+    message_metadata = alice.send_message(['bob'], 1519088028)
+    message_keys = set(message_metadata.store.keys())
+    bob.receive_message('alice', message_metadata)
+
+    # The message store is left intact, and its objects are kept.
+    assert set(message_metadata.store.keys()) == message_keys
+    assert message_keys <= set(bob.gossip_store.keys())
+
+
+def test_agent_gossip_store_garbage_collection():
+    with AgentSettings(gossip_store_gc_threshold=1).as_default():
+        alice = Agent('alice')
+        bob = Agent('bob')
+        carol = Agent('carol')
+
+        message_metadata = carol.send_message(['alice'], 1519088028)
+        alice.receive_message('carol', message_metadata)
+
+        for _ in range(5):
+            alice.update_chain()
+            message_metadata = alice.send_message(['bob', 'carol'],
+                                                  1519088028)
+            bob.receive_message('alice', message_metadata,
+                                other_recipients=['carol'])
+            message_metadata = carol.send_message(['bob'], 1519088028)
+            bob.receive_message('carol', message_metadata)
+
+        # Superseded heads of Alice have been evicted...
+        assert bob.nb_evicted_gossip_objects > 0
+        assert alice.head in bob.gossip_store
+        assert carol.head in bob.gossip_store
+        # ...and live views are still usable.
+        alice_view = bob.get_latest_view('alice')
+        assert alice_view.head == alice.head
+        assert ascii2bytes(alice_view.payload.mtr_hash) in bob.gossip_store
+        assert bob.get_latest_view('carol').payload is not None
+
+
+def test_agent_incremental_chain_update():
+    alice = Agent('alice')
+    bob = Agent('bob')
+    carol = Agent('carol')
+
+    message_metadata = carol.send_message(['alice'], 1519088028)
+    alice.receive_message('carol', message_metadata)
+    message_metadata = alice.send_message(['bob', 'carol'], 1519088028)
+    bob.receive_message('alice', message_metadata, other_recipients=['carol'])
+    message_metadata = bob.send_message(['alice'], 1519088028)
+    alice.receive_message('bob', message_metadata)
+    message_metadata = alice.send_message(['bob'], 1519088028)
+    alice.update_key()
+
+    # The state matches a full rebuild from the committed views and caps.
+    for friend, view in alice.committed_views.items():
+        latest_block = view.chain.store.get(view.head)
+        assert alice.state[friend] == serialize_block(latest_block)
+    for reader, contacts in alice.committed_caps.items():
+        reader_dh_pk = alice.get_latest_view(reader, save=False).params.dh.pk
+        assert set(alice.state.get_capabilities(reader_dh_pk)) == contacts
+
+
+def test_agent_reuse_encodings():
+    with AgentSettings(reuse_encodings=True).as_default():
+        alice = Agent('alice')
+        bob = Agent('bob')
+        carol = Agent('carol')
+
+        message_metadata = carol.send_message(['alice'], 1519088028)
+        alice.receive_message('carol', message_metadata)
+        message_metadata = alice.send_message(['bob', 'carol'], 1519088028)
+        bob.receive_message('alice', message_metadata,
+                            other_recipients=['carol'])
+        message_metadata = bob.send_message(['alice'], 1519088028)
+        alice.receive_message('bob', message_metadata)
+
+        # Unchanged entries are not encoded again.
+        nb_cache_misses = alice.state.nb_cache_misses
+        nb_nonce_reuses = alice.state.nb_nonce_reuses
+        alice.update_chain()
+        assert alice.state.nb_cache_misses == nb_cache_misses
+        assert alice.state.nb_cache_hits > 0
+        # ...since the nonce is reused, which is a protocol deviation.
+        assert alice.state.nb_nonce_reuses == nb_nonce_reuses + 1
+
+        message_metadata = alice.send_message(['bob'], 1519088028)
+        bob.receive_message('alice', message_metadata)
+        assert bob.get_latest_view('alice').head == alice.head
+        assert bob.get_latest_view('carol').head == carol.head
+
+        # Key rotation drops the cached encodings.
+        alice.update_key()
+        assert alice.state.nb_cache_misses > nb_cache_misses
+
+
+def test_block_cache():
+    alice = Agent('alice')
+    block = alice.chain_store[alice.head]
+
+    serialized_block = serialize_block(block, alice.head)
+    assert serialize_block(block, alice.head) is serialized_block
+
+    decoded_block = deserialize_block(serialized_block)
+    hits = decoded_block_cache.hits
+    assert deserialize_block(serialized_block) is decoded_block
+    assert decoded_block_cache.hits == hits + 1
+    assert decoded_block.hid == alice.head
+
+
+def test_agent_claim_lookup_cache():
+    alice = Agent('alice')
+    bob = Agent('bob')
+    carol = Agent('carol')
+
+    message_metadata = carol.send_message(['alice'], 1519088028)
+    alice.receive_message('carol', message_metadata)
+
+    # Bob can not read Alice's claim about Carol yet.
+    message_metadata = alice.send_message(['bob', 'carol'], 1519088028)
+    bob.receive_message('alice', message_metadata,
+                        other_recipients=['carol'])
+    alice_head0 = alice.head
+    assert bob.claim_lookups[alice_head0] == {'carol': None}
+
+    # Bob -> Alice, and Alice -> Bob with an updated chain.
+    message_metadata = bob.send_message(['alice'], 1519088028)
+    alice.receive_message('bob', message_metadata)
+    message_metadata = alice.send_message(['bob'], 1519088028)
+    bob.receive_message('alice', message_metadata)
+
+    # Lookups against the old head are dropped.
+    assert alice_head0 not in bob.claim_lookups
+    assert bob.claim_lookups[alice.head]['carol'] == carol.head
+
+
+def test_agent_compact_layout():
+    alice = Agent('alice')
+    bob = Agent('bob')
+    assert not hasattr(alice, '__dict__')
+
+    # Unused containers are shared between agents.
+    assert alice.queued_views is bob.queued_views
+    assert alice.global_views is bob.global_views
+    fresh_size = get_deep_size(alice)
+
+    message_metadata = alice.send_message(['bob'], 1519088028)
+    bob.receive_message('alice', message_metadata)
+    assert bob.sender_heads is not alice.sender_heads
+    assert 'alice' in bob.expected_views
+    assert not alice.expected_views
+    assert get_deep_size(bob) > fresh_size
+
+
+def test_agent_receive_shares_decoded_sender_view():
+    alice = Agent('alice')
+    bob = Agent('bob')
+    carol = Agent('carol')
+
+    message_metadata = alice.send_message(['bob', 'carol'], 1519088028)
+    bob.receive_message('alice', message_metadata, other_recipients=['carol'])
+    carol.receive_message('alice', message_metadata, other_recipients=['bob'])
+
+    bob_view = bob.expected_views['alice']
+    carol_view = carol.expected_views['alice']
+    assert bob_view.head == carol_view.head == alice.head
+    assert bob_view.payload is carol_view.payload
+    assert bob_view.params is carol_view.params
+    assert carol_view._viewer_params is carol.params
+
+
+def test_stub_agent():
+    alice = Agent('alice')
+    bob = Agent('bob')
+    stub = StubAgent('stub')
+    full = Agent('full')
+
+    for agent in [stub, full]:
+        message_metadata = alice.send_message([agent.email], 1519088028)
+        agent.receive_message('alice', message_metadata)
+        message_metadata = bob.send_message([agent.email], 1519088028)
+        agent.receive_message('bob', message_metadata)
+    assert stub.get_latest_view('alice').head == alice.head
+
+    # The stub introduces the recipients to each other, as a full
+    # agent would.
+    message_metadata = stub.send_message(['alice', 'bob'], 1519088028)
+    alice.receive_message('stub', message_metadata, other_recipients=['bob'])
+    assert alice.get_latest_view('stub').head == stub.head
+    assert alice.global_views['stub']['bob'].head == bob.head
+    assert alice.get_latest_view('bob').head == bob.head
+
+    # Claims of the stub can be read after the wire encoding.
+    decoded_metadata = decode_message(encode_message(message_metadata))
+    bob.receive_message('stub', decoded_metadata, other_recipients=['alice'])
+    assert bob.global_views['stub']['alice'].head == alice.head
+
+    # Messages of the stub have the same objects as a full agent's,
+    # up to the varying sizes of the real signatures.
+    full_message_metadata = full.send_message(['alice', 'bob'], 1519088028)
+    assert len(message_metadata.store) == len(full_message_metadata.store)
+    assert abs(len(encode_message(message_metadata)) -
+               len(encode_message(full_message_metadata))) <= 8
+
+    # The stub keeps its chain, but only the tree of the latest block.
+    previous_root_hash = stub.state.tree.root_hash
+    stub.update_key(1519088028)
+    assert len(list(stub.chain_store.keys())) == 3
+    assert stub.tree_store.get(previous_root_hash) is None
+    assert stub.tree_store.get(stub.state.tree.root_hash) is not None
+    assert stub.current_enc_key is not None
+
+
+def test_make_view_decodes_heads_once():
+    alice = Agent('alice')
+    first_view = make_view(Chain(alice.chain_store, root_hash=alice.head))
+    hits = decoded_view_cache.hits
+    with alice.params.as_default():
+        second_view = make_view(Chain(alice.chain_store, root_hash=alice.head))
+
+    assert decoded_view_cache.hits == hits + 1
+    assert second_view is not first_view
+    assert second_view.payload is first_view.payload
+    assert second_view.params is first_view.params
+    assert second_view._viewer_params is alice.params
+
+
+def test_batched_chain_update_policies():
+    alice = Agent('alice')
+    assert alice.nb_commits == 1
+    alice.update_chain(mtime=1519088028)
+    alice.queue_caps('bob', ['carol'])
+    assert alice.nb_queued_updates == 1
+
+    with AgentSettings(chain_update_buffer_size=2).as_default():
+        assert not buffered_chain_update_policy(alice, {'bob'})
+        alice.queue_caps('bob', ['dave'])
+        assert buffered_chain_update_policy(alice, {'bob'})
+        # Updates that are not relevant to the recipients are held back.
+        assert not buffered_chain_update_policy(alice, {'carol'})
+
+    with AgentSettings(chain_update_window=3600).as_default():
+        assert not windowed_chain_update_policy(
+                alice, {'bob'}, 1519088028 + 1800)
+        assert windowed_chain_update_policy(
+                alice, {'bob'}, 1519088028 + 3600)
+
+    with AgentSettings(chain_update_max_staleness=3600).as_default():
+        alice.time_of_first_queued_update = 1519088028
+        assert not staleness_bound_chain_update_policy(
+                alice, {'carol'}, 1519088028 + 1800)
+        assert staleness_bound_chain_update_policy(
+                alice, {'carol'}, 1519088028 + 3600)
+
+    alice.update_chain(mtime=1519088028 + 3600)
+    assert alice.nb_commits == 3
+    assert alice.nb_queued_updates == 0
+    assert alice.time_of_first_queued_update is None
+    assert alice.time_of_last_commit == 1519088028 + 3600
+
+
+def test_agent_buffered_chain_update():
+    settings = AgentSettings(chain_update_policy=buffered_chain_update_policy,
+                             chain_update_buffer_size=3)
+    with settings.as_default():
+        alice = Agent('alice')
+        bob = Agent('bob')
+        carol = Agent('carol')
+        for sender in [bob, carol]:
+            message_metadata = sender.send_message(['alice'], 1519088028)
+            alice.receive_message(sender.email, message_metadata)
+
+        # Views of Bob and Carol and a capability for Bob are queued,
+        # but the buffer is not full yet.
+        alice.send_message(['bob'], 1519088028)
+        assert alice.nb_commits == 1
+        assert alice.nb_queued_updates == 2
+        assert alice.time_of_first_queued_update == 1519088028
+
+        alice.send_message(['bob', 'carol'], 1519088029)
+        assert alice.nb_commits == 2
+        assert alice.nb_queued_updates == 0
+        assert alice.time_of_last_commit == 1519088029
+
+
+def test_updated_contacts_only_tracked_for_public_policy():
+    alice = Agent('alice')
+    carol = Agent('carol')
+
+    message_metadata = carol.send_message(['alice', 'bob'], 1519088028)
+    alice.receive_message('carol', message_metadata,
+                          other_recipients=['bob'])
+    assert alice.updated_contacts == set()
+
+
+def test_public_contacts_policy_is_incremental():
+    public_setting = AgentSettings(
+            introduction_policy=public_contacts_policy)
+    with public_setting.as_default():
+        alice = Agent('alice')
+        carol = Agent('carol')
+
+        message_metadata = carol.send_message(['alice'], 1519088028)
+        alice.receive_message('carol', message_metadata)
+        assert alice.updated_contacts == {'carol'}
+
+        alice.send_message(['bob'], 1519088028)
+        assert alice.committed_caps[PUBLIC_READER_LABEL] == {'carol'}
+        assert alice.updated_contacts == set()
+        nb_commits = alice.nb_commits
+
+        # Nothing is resolved or committed again without new evidence.
+        alice.send_message(['bob'], 1519088029)
+        assert alice.nb_queued_updates == 0
+
+
+def test_agent_group_capabilities():
+    with AgentSettings(group_capability_min_size=3).as_default():
+        alice = Agent('alice')
+        # Wide enough for a group to be cheaper than pairs.
+        friends = [Agent(email) for email in
+                   ['bob', 'carol', 'dave', 'eve', 'frank', 'grace', 'heidi']]
+        for friend in friends:
+            message_metadata = friend.send_message(['alice'], 1519088028)
+            alice.receive_message(friend.email, message_metadata)
+
+        recipients = {friend.email for friend in friends}
+        message_metadata = alice.send_message(recipients, 1519088028)
+        group_label = get_group_label(recipients)
+        assert set(alice.groups) == {group_label}
+
+        # Each member only gets a capability for the group key, and the
+        # group gets one capability per member.
+        assert alice.committed_caps['bob'] == {group_label}
+        assert alice.committed_caps[group_label] == recipients
+        nb_cap_entries = sum(
+                len(caps) for caps in alice.state._caps_by_reader_pk.values())
+        assert nb_cap_entries == 2 * len(recipients)
+
+        # Members can read each other's heads through the group.
+        for friend in friends:
+            friend.receive_message('alice', message_metadata,
+                                   recipients - {friend.email})
+        bob = friends[0]
+        assert bob.groups_by_sender['alice'][group_label].params is not None
+        assert bob.global_views['alice']['carol'].head == friends[1].head
+        assert bob.global_views['alice']['dave'].head == friends[2].head
+
+
+def test_agent_grants_narrow_groups_per_pair():
+    with AgentSettings(group_capability_min_size=3).as_default():
+        alice = Agent('alice')
+        friends = [Agent(email) for email in ['bob', 'carol', 'dave']]
+        for friend in friends:
+            message_metadata = friend.send_message(['alice'], 1519088028)
+            alice.receive_message(friend.email, message_metadata)
+
+        # Nine capabilities are cheaper than a group key claim.
+        recipients = {'bob', 'carol', 'dave'}
+        alice.send_message(recipients, 1519088028)
+        assert not alice.groups
+        assert alice.committed_caps['bob'] == recipients
+        assert len(alice.state._claim_content_by_label) == len(recipients)
+
+
+def test_agent_reuses_wider_groups(monkeypatch):
+    monkeypatch.setattr('simulations.agent.GROUP_KEY_CLAIM_COST', 0)
+    with AgentSettings(group_capability_min_size=3).as_default():
+        alice = Agent('alice')
+        friends = [Agent(email) for email in ['bob', 'carol', 'dave', 'eve']]
+        for friend in friends:
+            message_metadata = friend.send_message(['alice'], 1519088028)
+            alice.receive_message(friend.email, message_metadata)
+
+        def get_nb_entries():
+            return len(alice.state._claim_content_by_label) + sum(
+                len(caps) for caps in alice.state._caps_by_reader_pk.values())
+
+        bob = friends[0]
+        wide_recipients = {'bob', 'carol', 'dave', 'eve'}
+        message_metadata = alice.send_message(wide_recipients, 1519088028)
+        bob.receive_message('alice', message_metadata,
+                            wide_recipients - {'bob'})
+        nb_entries = get_nb_entries()
+
+        # An email to some of the members does not need a new group key,
+        # since they can already read each other's claims.
+        recipients = {'bob', 'carol', 'dave'}
+        message_metadata = alice.send_message(recipients, 1519088028)
+        bob.receive_message('alice', message_metadata, recipients - {'bob'})
+        assert set(alice.groups) == {get_group_label(wide_recipients)}
+        assert set(bob.groups_by_sender['alice']) == \
+               {get_group_label(wide_recipients)}
+        assert get_nb_entries() == nb_entries
+
+
+def test_agent_wire_messages():
+    alice = Agent('alice')
+    bob = Agent('bob')
+    carol = Agent('carol')
+
+    message_metadata = carol.send_message(['alice'], 1519088028)
+    alice.receive_message('carol', decode_message(
+            encode_message(message_metadata)))
+    message_metadata = bob.send_message(['alice'], 1519088028)
+    alice.receive_message('bob', decode_message(
+            encode_message(message_metadata)))
+
+    # Decoded objects are equivalent to the sent ones.
+    message_metadata = alice.send_message(['bob', 'carol'], 1519088028)
+    buffer = encode_message(message_metadata)
+    decoded_metadata = decode_message(buffer)
+    assert decoded_metadata.head == message_metadata.head
+    assert decoded_metadata.public_contacts == \
+            message_metadata.public_contacts
+    assert set(decoded_metadata.store) == set(message_metadata.store)
+    for key, obj in decoded_metadata.store.items():
+        assert obj.hid == key
+        assert obj is not message_metadata.store[key]
+
+    # Bob learns about Carol from the decoded message.
+    bob.receive_message('alice', decoded_metadata,
+                        other_recipients=['carol'])
+    assert bob.get_latest_view('alice').head == alice.head
+    assert bob.get_latest_view('carol').head == carol.head
+
+
+def test_fork_detecting_resolution_policy():
+    alice = Agent('alice')
+    bob = Agent('bob')
+    fork_base = alice.head
+    alice.update_chain()
+    alice.update_chain()
+    honest_head = alice.head
+    alice.chain.head = fork_base
+    alice.update_chain()
+    forked_head = alice.head
+
+    with bob.params.as_default():
+        base_view, honest_view, forked_view = [
+                make_view(Chain(alice.chain_store, root_hash=head))
+                for head in [fork_base, honest_head, forked_head]]
+        resolved_view = fork_detecting_resolution_policy(
+                bob, {base_view, honest_view})
+        assert resolved_view.head in {fork_base, honest_head}
+        assert bob.nb_detected_forks == 0
+
+        fork_detecting_resolution_policy(
+                bob, {base_view, honest_view, forked_view})
+        assert bob.nb_detected_forks == 1
+
+        # Forks are only counted once.
+        fork_detecting_resolution_policy(bob, {honest_view, forked_view})
+        assert bob.nb_detected_forks == 1
+
+
+def test_fork_detection_with_gossip_garbage_collection():
+    settings = AgentSettings(
+            conflict_resolution_policy=fork_detecting_resolution_policy,
+            gossip_store_gc_threshold=1)
+    with settings.as_default():
+        alice = Agent('alice')
+        bob = Agent('bob')
+        fork_base = alice.head
+        for _ in range(8):
+            alice.update_chain()
+            message_metadata = alice.send_message(['bob'], 1519088028)
+            bob.receive_message('alice', message_metadata)
+        honest_head = alice.head
+        alice.chain.head = fork_base
+        alice.update_chain()
+        forked_head = alice.head
+
+        # Superseded blocks were evicted, but are still indexed.
+        assert bob.nb_evicted_gossip_objects > 0
+        with bob.params.as_default():
+            honest_view = make_view(
+                    Chain(bob.gossip_store, root_hash=honest_head))
+            forked_view = make_view(
+                    Chain(alice.chain_store, root_hash=forked_head))
+            fork_detecting_resolution_policy(
+                    bob, {honest_view, forked_view})
+        assert bob.nb_detected_forks == 1
+
+
+def test_agent_receive_skips_resolved_contacts(monkeypatch):
+    alice = Agent('alice')
+    bob = Agent('bob')
+    looked_up_contacts = []
+    get_contact_head_from_view = Agent.get_contact_head_from_view
+
+    def counting_get_contact_head_from_view(self, view, contact, *args):
+        looked_up_contacts.append(contact)
+        return get_contact_head_from_view(self, view, contact, *args)
+
+    monkeypatch.setattr(Agent, 'get_contact_head_from_view',
+                        counting_get_contact_head_from_view)
+
+    message_metadata = alice.send_message(['bob', 'carol'], 1519088028)
+    bob.receive_message('alice', message_metadata, other_recipients=['carol'])
+    assert looked_up_contacts == ['carol']
+
+    # Same head, so only the new contact is looked up.
+    head = alice.head
+    message_metadata = alice.send_message(['bob', 'carol', 'dave'],
+                                          1519088028)
+    assert alice.head == head
+    bob.receive_message('alice', message_metadata,
+                        other_recipients=['carol', 'dave'])
+    assert looked_up_contacts == ['carol', 'dave']
+
+    # A new head invalidates all of them.
+    alice.update_chain()
+    message_metadata = alice.send_message(['bob'], 1519088028)
+    bob.receive_message('alice', message_metadata)
+    assert sorted(looked_up_contacts[2:]) == ['carol', 'dave']
@@ -0,0 +1,45 @@
+from hippiehug import Chain
+
+from simulations.ancestry import AncestryIndex
+
+
+class CountingStore(dict):
+    def __init__(self, *args, **kwargs):
+        super(CountingStore, self).__init__(*args, **kwargs)
+        self.nb_reads = 0
+
+    def __getitem__(self, key):
+        self.nb_reads += 1
+        return super(CountingStore, self).__getitem__(key)
+
+
+def make_chain(store, length, root_hash=None):
+    chain = Chain(store, root_hash=root_hash)
+    heads = []
+    for i in range(length):
+        chain.multi_add([b'item %d' % i])
+        heads.append(chain.head)
+    return heads
+
+
+def test_ancestry_index():
+    store = CountingStore()
+    heads = make_chain(store, 1000)
+    forked_heads = make_chain(store, 10, root_hash=heads[499])
+
+    index = AncestryIndex()
+    for head in [heads[0], heads[500], heads[-1], forked_heads[-1]]:
+        index.add(head, store[head])
+    store.nb_reads = 0
+
+    assert index.is_ancestor(heads[0], heads[-1], store)
+    assert index.is_ancestor(heads[500], heads[-1], store)
+    assert not index.is_ancestor(heads[-1], heads[500], store)
+    # Blocks are only read through the skip links.
+    assert 0 < store.nb_reads <= 2 * 10
+
+    assert index.is_fork(forked_heads[-1], heads[-1], store)
+    assert not index.is_fork(heads[-1], heads[500], store)
+
+    # Ancestry can not be traced without the blocks on the way.
+    assert AncestryIndex().is_fork(heads[0], heads[-1]) is None
@@ -0,0 +1,95 @@
+import pytest
+
+from hippiehug import Chain
+from claimchain import State, View, LocalParams
+from claimchain.core import encode_claim as real_encode_claim
+from claimchain.core import encode_capability as real_encode_capability
+
+from simulations.agent import Agent, AgentSettings
+from simulations.fast import *
+
+
+@pytest.fixture
+def fast_settings():
+    with AgentSettings(fast_backend=True).as_default() as settings:
+        yield settings
+
+
+def test_fast_params_export():
+    params = FastParams.generate()
+    real_params = LocalParams.generate()
+    exported = params.public_export()
+    assert {key: len(value) for key, value in exported.items()} == \
+           {key: len(value)
+            for key, value in real_params.public_export().items()}
+    assert FastParams.from_dict(exported).dh.pk == params.dh.pk
+
+
+def test_fast_encodings_have_real_sizes():
+    params = FastParams.generate()
+    real_params = LocalParams.generate()
+    reader_params = LocalParams.generate()
+    nonce = b'n' * 16
+    content = b'content' * 10
+
+    with params.as_default():
+        vrf_value, lookup_key, enc_claim = encode_claim(
+                nonce, 'label', content)
+        cap_lookup_key, enc_cap = encode_capability(
+                reader_params.dh.pk, nonce, 'label', vrf_value)
+    with real_params.as_default():
+        real_vrf_value, real_lookup_key, real_enc_claim = real_encode_claim(
+                nonce, 'label', content)
+        real_cap_lookup_key, real_enc_cap = real_encode_capability(
+                reader_params.dh.pk, nonce, 'label', real_vrf_value)
+
+    assert len(vrf_value) == len(real_vrf_value)
+    assert len(lookup_key) == len(real_lookup_key)
+    assert len(enc_claim) == len(real_enc_claim)
+    assert len(cap_lookup_key) == len(real_cap_lookup_key)
+    assert len(enc_cap) == len(real_enc_cap)
+
+
+def test_fast_view_access():
+    owner_params = FastParams.generate()
+    reader_params = FastParams.generate()
+    other_params = FastParams.generate()
+
+    chain = Chain()
+    with owner_params.as_default():
+        state = FastState()
+        state['label'] = b'content'
+        state.grant_access(reader_params.dh.pk, ['label'])
+        state.commit(chain)
+        assert FastView(chain)['label'] == b'content'
+
+    with reader_params.as_default():
+        assert FastView(chain)['label'] == b'content'
+    with other_params.as_default():
+        assert FastView(chain).get('label') is None
+
+
+def test_fast_agents(fast_settings):
+    alice = Agent('alice')
+    bob = Agent('bob')
+    carol = Agent('carol')
+    assert isinstance(alice.params, FastParams)
+
+    message_metadata = carol.send_message(['alice'], 1519088028)
+    alice.receive_message('carol', message_metadata)
+    message_metadata = alice.send_message(['bob', 'carol'], 1519088028)
+    bob.receive_message('alice', message_metadata,
+                        other_recipients=['carol'])
+
+    alice_view = bob.get_latest_view('alice')
+    assert isinstance(alice_view, FastView)
+    assert alice_view.head == alice.head
+    assert bob.get_latest_view('carol') is None
+
+    # Alice can introduce Carol once she knows Bob's key.
+    message_metadata = bob.send_message(['alice'], 1519088028)
+    alice.receive_message('bob', message_metadata)
+    message_metadata = alice.send_message(['bob', 'carol'], 1519088028)
+    bob.receive_message('alice', message_metadata,
+                        other_recipients=['carol'])
+    assert bob.get_latest_view('carol').head == carol.head
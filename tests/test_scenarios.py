@@ -2,8 +2,10 @@ import sys
 import pytest
 import logging
 
+from scripts.parse_enron import Message
 from simulations.scenarios import *
 from simulations.agent import *
+from simulations.utils import Context
 
 
 # TODO: Investigate why this differs from dummies.
@@ -51,3 +53,61 @@ def test_private_claimchain(context, agent_setting):
         enc_stats = reports.encryption_status_data.value_counts()
         logger.info(enc_stats)
         assert enc_stats[EncStatus.plaintext] == PRIVATE_NB_PLAINTEXTS
+
+
+def test_group_capabilities_match_pairwise_ones(monkeypatch):
+    # Make groups cheaper than pairs, so that every wide email uses one.
+    monkeypatch.setattr('simulations.agent.GROUP_KEY_CLAIM_COST', 0)
+    # Emails with wide CC lists, and frequent key updates.
+    recipients = [
+        ('u1', 'u4', 'u0 u3'), ('u1', 'u0', 'u5'), ('u3', 'u1', 'u0 u2 u5'),
+        ('u4', 'u1', 'u0 u2'), ('u2', 'u0', ''), ('u2', 'u1', ''),
+        ('u2', 'u4', 'u0 u5'), ('u2', 'u4', 'u0 u1 u3'), ('u1', 'u0', 'u2 u5'),
+        ('u0', 'u4', 'u1 u2'), ('u3', 'u4', 'u2'), ('u3', 'u1', 'u2'),
+        ('u2', 'u0', 'u5'), ('u3', 'u4', 'u2 u5'), ('u2', 'u1', 'u5'),
+        ('u0', 'u3', 'u1 u2'),
+    ]
+    log = [Message(sender, 1519088028 + 1000 * index, {to},
+                   set(cc.split()), set())
+           for index, (sender, to, cc) in enumerate(recipients)]
+
+    enc_statuses = []
+    for group_capability_min_size in [None, 3]:
+        agent_setting = AgentSettings(
+                key_update_every_nb_sent_emails=2, fast_backend=True,
+                group_capability_min_size=group_capability_min_size)
+        with agent_setting.as_default():
+            reports = simulate_claimchain(Context(log, social_graph={}),
+                                          pbar=lambda emails: emails)
+        enc_statuses.append(list(reports.encryption_status_data))
+    assert EncStatus.stale in enc_statuses[0]
+    assert enc_statuses[0] == enc_statuses[1]
+
+
+def test_validate_fast_backend(monkeypatch):
+    log = [Message('u0', 1519088028, {'u1'}, {'u2'}, set()),
+           Message('u1', 1519089028, {'u0'}, {'u2'}, set()),
+           Message('u2', 1519090028, {'u0'}, set(), set()),
+           Message('u0', 1519091028, {'u1', 'u2'}, set(), set())]
+    context = Context(log, social_graph={})
+    comparison = validate_fast_backend(context, pbar=lambda emails: emails)
+    assert comparison['encryption_status_mismatches'] == 0
+
+    # Mismatches are errors, not just logged.
+    monkeypatch.setattr(
+            'simulations.scenarios.compare_reports',
+            lambda reports, reference_reports: dict(
+                comparison, encryption_status_mismatches=1))
+    with pytest.raises(ValueError):
+        validate_fast_backend(context, pbar=lambda emails: emails)
+
+
+def test_transmit_payload_counts_one_copy_per_email():
+    codec = PayloadCodec('zlib', shared_dictionaries=True)
+    recipient_emails = ['u%d' % index for index in range(1, 10)]
+    payload = b'compressible payload ' * 100
+    outgoing_size, compressed_sizes, _, _ = transmit_payload(
+            codec, 'u0', recipient_emails, payload, recipient_emails)
+    assert outgoing_size <= len(payload)
+    assert outgoing_size * len(recipient_emails) == \
+            pytest.approx(sum(compressed_sizes.values()))
@@ -0,0 +1,117 @@
+import pytest
+
+from scripts.parse_enron import Message
+from simulations.scenarios import *
+from simulations.snapshot import *
+from simulations.utils import Context
+
+
+@pytest.fixture
+def logs():
+    first_log = [
+        Message('alice', 1519088028, {'bob'}, set(), set()),
+        Message('bob', 1519088128, {'alice'}, {'carol'}, set()),
+        Message('carol', 1519088228, {'alice'}, set(), set()),
+    ]
+    second_log = [
+        Message('alice', 1519088328, {'bob'}, {'carol'}, set()),
+    ]
+    return first_log, second_log
+
+
+def test_snapshot_warm_start(logs, tmpdir):
+    first_log, second_log = logs
+    first_context = Context(first_log, social_graph={})
+    global_state, reports = init_simulations(first_context)
+    for index, email in enumerate(first_log):
+        do_simulation_step(index, email, global_state, reports)
+
+    path = str(tmpdir.join('snapshot.pkl'))
+    save_snapshot(global_state, path)
+
+    second_context = Context(second_log, social_graph={})
+    warm_state = GlobalState(second_context, snapshot=load_snapshot(path))
+    assert set(warm_state.agents) == {'alice', 'bob', 'carol'}
+    assert warm_state.recipients_by_sender['bob'] == {'alice', 'carol'}
+    alice = warm_state.agents['alice']
+    assert alice.head == global_state.agents['alice'].head
+    assert alice.get_latest_view('carol').head == \
+           global_state.agents['carol'].head
+
+    # Alice already knows the keys of Bob and Carol.
+    do_simulation_step(0, second_log[0], warm_state, reports)
+    assert reports.encryption_status_data.loc[0] == EncStatus.encrypted
+
+
+def test_load_snapshot_streams_agents(logs, tmpdir):
+    first_log, second_log = logs
+    global_state, reports = init_simulations(Context(first_log,
+                                                     social_graph={}))
+    for index, email in enumerate(first_log):
+        do_simulation_step(index, email, global_state, reports)
+    path = str(tmpdir.join('snapshot.pkl'))
+    save_snapshot(global_state, path)
+
+    # Agents are unpickled as they are iterated over.
+    snapshot = load_snapshot(path)
+    email, agent = next(snapshot['agents'])
+    assert agent.head == global_state.agents[email].head
+    snapshot['agents'].close()
+
+    # Loaded agents are spilled one by one.
+    warm_state = GlobalState(Context(second_log, social_graph={}),
+                             max_resident_agents=1,
+                             snapshot=load_snapshot(path))
+    try:
+        assert warm_state.agents.nb_resident == 1
+        for email in ['alice', 'bob', 'carol']:
+            assert warm_state.agents[email].head == \
+                   global_state.agents[email].head
+    finally:
+        warm_state.close()
+
+
+def test_warm_up(logs):
+    first_log, second_log = logs
+    # Emails that were sent before are only replayed once.
+    first_log = first_log + [
+        Message('alice', 1519088298, {'bob'}, set(), set())]
+
+    global_state = GlobalState(Context(second_log, social_graph={}))
+    warm_up(global_state, first_log, pbar=lambda emails: emails)
+    assert global_state.agents['alice'].nb_sent_emails == 1
+    assert global_state.recipients_by_sender['bob'] == {'alice', 'carol'}
+
+    reports = SimulationReports(global_state.context)
+    do_simulation_step(0, second_log[0], global_state, reports)
+    assert reports.encryption_status_data.loc[0] == EncStatus.encrypted
+
+
+def test_save_snapshot_leaves_agents_alone(logs, tmpdir):
+    first_log, _ = logs
+    context = Context(first_log, social_graph={})
+    global_state, reports = init_simulations(context, max_resident_agents=1)
+    try:
+        for index, email in enumerate(first_log):
+            do_simulation_step(index, email, global_state, reports)
+        carol = global_state.agents['carol']
+        claim_lookups = set(carol.claim_lookups)
+        assert claim_lookups
+        nb_evicted = carol.nb_evicted_gossip_objects
+        nb_gossip_objects = len(carol.gossip_store)
+
+        path = str(tmpdir.join('snapshot.pkl'))
+        save_snapshot(global_state, path)
+        # Agents are reloaded one at a time, and saved as they were.
+        assert global_state.agents.nb_resident == 1
+        carol = global_state.agents['carol']
+        assert set(carol.claim_lookups) == claim_lookups
+        assert carol.nb_evicted_gossip_objects == nb_evicted
+        assert len(carol.gossip_store) == nb_gossip_objects
+
+        agents = dict(load_snapshot(path)['agents'])
+        assert set(agents) == {'alice', 'bob', 'carol'}
+        assert not agents['carol'].claim_lookups
+        assert agents['carol'].head == carol.head
+    finally:
+        global_state.close()
@@ -0,0 +1,109 @@
+import os
+import pytest
+
+from scripts.parse_enron import Message
+from simulations.agent import Agent
+from simulations.scenarios import do_simulation_step, init_simulations, \
+                                  record_agent_memory_sizes
+from simulations.spill import *
+from simulations.utils import EMPTY_DICT, Context, PooledObjectStore
+
+
+@pytest.fixture
+def agents(tmpdir):
+    agents = SpillingAgentStore(1, str(tmpdir.join('agents.sqlite')))
+    yield agents
+    agents.close()
+
+
+def test_agent_dump_and_load():
+    alice = Agent('alice')
+    bob = Agent('bob')
+    message_metadata = alice.send_message(['bob'], 1519088028)
+    bob.receive_message('alice', message_metadata)
+
+    reloaded_bob = load_agent(dump_agent(bob))
+    assert reloaded_bob.head == bob.head
+    assert reloaded_bob.queued_caps is EMPTY_DICT
+    assert reloaded_bob.get_latest_view('alice').head == alice.head
+
+    # The reloaded agent can still update its chain.
+    message_metadata = reloaded_bob.send_message(['alice'], 1519088028)
+    alice.receive_message('bob', message_metadata)
+    assert alice.get_latest_view('bob').head == reloaded_bob.head
+
+
+def test_spilling_agent_store(agents):
+    agents['alice'] = Agent('alice')
+    agents['bob'] = Agent('bob')
+    assert agents.nb_resident == 2
+
+    alice = agents['alice']
+    message_metadata = alice.send_message(['bob'], 1519088028)
+    agents['bob'].receive_message('alice', message_metadata)
+    agents.trim()
+    assert agents.nb_resident == 1
+    assert agents.nb_spills == 1
+    assert set(agents) == {'alice', 'bob'}
+
+    # Alice was spilled as the least recently used agent.
+    reloaded_alice = agents['alice']
+    assert reloaded_alice is not alice
+    assert reloaded_alice.head == alice.head
+    assert agents.nb_reloads == 1
+    assert agents['bob'].get_latest_view('alice').head == alice.head
+
+
+def test_memory_sizes_skip_spilled_agents(tmpdir):
+    context = Context([], social_graph={})
+    global_state, reports = init_simulations(
+            context, max_resident_agents=1,
+            spill_path=str(tmpdir.join('agents.sqlite')),
+            record_memory_sizes=True)
+    global_state.agents['alice'] = Agent('alice')
+    global_state.agents['bob'] = Agent('bob')
+    global_state.trim_agents()
+
+    record_agent_memory_sizes(global_state, reports)
+    assert list(reports.agent_memory_size_data.index) == ['bob']
+    assert global_state.agents.nb_reloads == 0
+
+
+def test_spilling_agent_store_deletes_temporary_database(tmpdir):
+    agents = SpillingAgentStore(1)
+    agents['alice'] = Agent('alice')
+    agents['bob'] = Agent('bob')
+    agents.trim()
+    assert os.path.exists(agents.path)
+    agents.close()
+    assert not os.path.exists(agents.path)
+
+    # Databases at given paths are kept.
+    path = str(tmpdir.join('agents.sqlite'))
+    agents = SpillingAgentStore(1, path)
+    agents.close()
+    assert os.path.exists(path)
+
+
+def test_reloaded_agents_share_gossip_objects():
+    log = [
+        Message('alice', 1519088028, {'bob', 'carol'}, set(), set()),
+        Message('bob', 1519088128, {'alice'}, set(), set()),
+        Message('carol', 1519088228, {'alice'}, set(), set()),
+    ]
+    context = Context(log, social_graph={})
+    global_state, reports = init_simulations(context)
+    assert not isinstance(global_state.agents['bob'].gossip_store,
+                          PooledObjectStore)
+
+    global_state, reports = init_simulations(context, max_resident_agents=1)
+    try:
+        do_simulation_step(0, log[0], global_state, reports)
+        head = global_state.agents['alice'].head
+        bob = global_state.agents['bob']
+        global_state.trim_agents()
+        carol = global_state.agents['carol']
+        global_state.trim_agents()
+        assert bob.gossip_store[head] is carol.gossip_store[head]
+    finally:
+        global_state.close()
@@ -0,0 +1,86 @@
+from hippiehug import Chain
+from claimchain import State, LocalParams
+from claimchain.core import _compute_claim_key, get_capability_lookup_key
+
+from simulations.state import *
+
+
+def make_states(*states):
+    readers = [LocalParams.generate() for _ in range(4)]
+    labels = ['contact%d' % i for i in range(20)]
+    for state in states:
+        for label in labels:
+            state[label] = label.encode('utf-8') * 10
+        for reader in readers:
+            state.grant_access(reader.dh.pk, labels)
+    return states
+
+
+def get_capability_entries(state):
+    # Claims include randomized VRF proofs, so only capabilities are
+    # reproducible.
+    claim_lookup_keys = {_compute_claim_key(vrf_value, mode='lookup')
+                         for vrf_value in state._vrf_value_by_label.values()}
+    return {lookup_key: enc_item
+            for lookup_key, enc_item in state._enc_items_map.items()
+            if lookup_key not in claim_lookup_keys}
+
+
+def test_batch_state_matches_serial_commit():
+    params = LocalParams.generate()
+    nonce = b'0' * 16
+    serial_state, batch_state = make_states(
+            State(), BatchState())
+
+    with params.as_default():
+        serial_state.commit(Chain(), nonce=nonce)
+        batch_state.commit(Chain(), nonce=nonce)
+
+    assert batch_state._enc_items_map.keys() == \
+            serial_state._enc_items_map.keys()
+    assert get_capability_entries(batch_state) == \
+            get_capability_entries(serial_state)
+
+
+def test_caching_state_reuses_encodings():
+    params = LocalParams.generate()
+    serial_state, caching_state = make_states(
+            State(), CachingState())
+
+    with params.as_default():
+        caching_state.commit(Chain())
+        nb_cache_misses = caching_state.nb_cache_misses
+        caching_state.commit(Chain())
+        assert caching_state.nb_cache_misses == nb_cache_misses
+
+        serial_state.commit(Chain(), nonce=caching_state._nonce)
+
+    assert caching_state._enc_items_map.keys() == \
+            serial_state._enc_items_map.keys()
+    assert get_capability_entries(caching_state) == \
+            get_capability_entries(serial_state)
+
+
+def test_batch_state_caches_shared_secrets():
+    params = LocalParams.generate()
+    nonce = b'0' * 16
+    serial_state, batch_state = make_states(State(), BatchState())
+
+    with params.as_default():
+        batch_state.commit(Chain(), nonce=nonce)
+        batch_state.commit(Chain(), nonce=nonce)
+        assert batch_state.nb_shared_secret_computations == 4
+
+        serial_state.commit(Chain(), nonce=nonce)
+        reader_dh_pk = next(iter(serial_state._caps_by_reader_pk))
+        assert batch_state._get_capability_lookup_key(
+                reader_dh_pk, 'contact0') == get_capability_lookup_key(
+                reader_dh_pk, nonce, 'contact0')
+        assert batch_state.compute_evidence_keys(reader_dh_pk, 'contact0')
+
+        batch_state.clear_shared_secrets(reader_dh_pk)
+        batch_state.commit(Chain(), nonce=nonce)
+        assert batch_state.nb_shared_secret_computations == 5
+
+    assert get_capability_entries(batch_state) == \
+            get_capability_entries(serial_state)
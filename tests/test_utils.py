@@ -0,0 +1,87 @@
+import os
+import pytest
+
+from msgpack import packb
+from claimchain.utils.wrappers import Blob, ObjectStore
+
+from simulations.utils import *
+
+
+def test_lru_cache_eviction():
+    cache = LRUCache(maxsize=2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1
+    cache['c'] = 3
+
+    # 'b' was the least recently used entry.
+    assert 'b' not in cache
+    assert 'a' in cache and 'c' in cache
+    assert cache.get('b') is None
+    assert cache.hit_rate == 0.5
+
+
+def test_pooled_object_store():
+    pool = ObjectPool()
+    first_store = PooledObjectStore(pool)
+    second_store = PooledObjectStore(pool)
+
+    blob = Blob(b'test')
+    first_store.add(blob)
+    second_store[blob.hid] = Blob(b'test')
+    assert len(pool) == 1
+    assert second_store[blob.hid] is blob
+    assert dict(second_store.items()) == {blob.hid: blob}
+
+    del first_store[blob.hid]
+    assert blob.hid not in first_store
+    assert len(pool) == 1
+
+    # References are released when a store is garbage collected.
+    del second_store
+    assert len(pool) == 0
+
+
+def test_packed_store_size():
+    store = ObjectStore()
+    for i in range(20):
+        store.add(Blob(b'content %d' % i))
+        assert get_packed_store_size(store) == \
+               len(packb(serialize_store(store)))
+
+
+def test_payload_codec_shared_dictionaries():
+    codec = PayloadCodec('zlib', shared_dictionaries=True)
+    payload = os.urandom(1024)
+    compressed = codec.compress(payload, codec.get_dictionary('a', 'b'))
+    codec.update_dictionary('a', 'b', payload)
+
+    # Repeated content compresses against the previous payloads.
+    dictionary = codec.get_dictionary('a', 'b')
+    compressed_again = codec.compress(payload, dictionary)
+    assert len(compressed_again) < len(compressed) // 10
+    assert codec.decompress(compressed_again, dictionary) == payload
+    assert codec.get_dictionary('a', 'c') == b''
+
+
+def test_verified_object_store():
+    hashed_blobs = []
+
+    class CountingBlob(Blob):
+        @property
+        def hid(self):
+            hashed_blobs.append(self)
+            return Blob(self).hid
+
+    store = VerifiedObjectStore()
+    blob = CountingBlob(b'verified')
+    store[blob.hid] = blob
+    hashed_blobs.clear()
+
+    # Objects are only hashed on the first check.
+    for _ in range(3):
+        assert store[Blob(blob).hid] is blob
+    assert len(hashed_blobs) == 0
+
+    with pytest.raises(ValueError):
+        store[b'wrong key'] = Blob(b'other')